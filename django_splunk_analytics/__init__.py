@@ -0,0 +1 @@
+default_app_config = 'django_splunk_analytics.apps.DjangoSplunkAnalyticsConfig'
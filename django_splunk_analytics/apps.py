@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""apps.py: Django """
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import logging
+
+from django.apps import AppConfig, apps
+from django.conf import settings
+
+__author__ = 'Steven Klass'
+__date__ = '1/12/17 11:38'
+__credits__ = ['Steven Klass', ]
+
+log = logging.getLogger(__name__)
+
+
+class DjangoSplunkAnalyticsConfig(AppConfig):
+    name = 'django_splunk_analytics'
+
+    def ready(self):
+        """Hook up the change queue for every model listed in SPLUNK_ANALYTICS_QUEUE_MODELS and those of
+        the queue collectors in SPLUNK_ANALYTICS_COLLECTORS - saves happen in every process (i.e. the web
+        workers), not just the one running the collectors."""
+        from .signals import track_model_changes
+        for label in getattr(settings, 'SPLUNK_ANALYTICS_QUEUE_MODELS', []):
+            track_model_changes(apps.get_model(label))
+        if getattr(settings, 'SPLUNK_ANALYTICS_COLLECTORS', None):
+            # Registering a queue collector tracks its model
+            from .data_model import get_collectors
+            get_collectors()
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""benchmark.py: Django """
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import datetime
+import decimal
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__author__ = 'Steven Klass'
+__date__ = '1/12/17 11:38'
+__credits__ = ['Steven Klass', ]
+
+log = logging.getLogger(__name__)
+
+# Collects timings for the collector pipeline on a synthetic model with a simple_history style table:
+#
+#   python -m django_splunk_analytics.benchmark -n 10000 -m 5
+#
+# Always runs against an in-memory SQLite database and talks to a stub Splunk endpoint so
+# delete_items (and the HEC sink) can be measured too.  Pass --memory for per phase peak memory
+# (tracemalloc) - it slows every phase down so leave it off when comparing timings.
+
+
+def configure():
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+            INSTALLED_APPS=['django.contrib.contenttypes', 'django_splunk_analytics'],
+            USE_TZ=True)
+    elif settings.DATABASES['default'].get('NAME') != ':memory:':
+        raise RuntimeError("The benchmark creates tables - it only runs against an in-memory database")
+    import django
+    django.setup()
+
+
+# The synthetic model classes once get_models() has defined them
+_models = {}
+
+
+def get_models():
+    """A synthetic model and its simple_history style table - the classes are only defined once a process"""
+    if 'models' in _models:
+        return _models['models']
+    from django.db import models
+
+    class BenchmarkObject(models.Model):
+        name = models.CharField(max_length=64, null=True)
+        code = models.CharField(max_length=16, null=True)
+        amount = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+        count = models.IntegerField(default=0)
+        created = models.DateTimeField(null=True)
+
+        class Meta:
+            app_label = 'django_splunk_analytics'
+            verbose_name = 'benchmark object'
+
+    class HistoricalBenchmarkObject(models.Model):
+        id = models.IntegerField(db_index=True)
+        name = models.CharField(max_length=64, null=True)
+        code = models.CharField(max_length=16, null=True)
+        amount = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+        count = models.IntegerField(default=0)
+        created = models.DateTimeField(null=True)
+        history_id = models.AutoField(primary_key=True)
+        history_date = models.DateTimeField(db_index=True)
+        history_type = models.CharField(max_length=1, choices=[('+', 'Created'), ('~', 'Changed'), ('-', 'Deleted')])
+
+        class Meta:
+            app_label = 'django_splunk_analytics'
+            ordering = ('-history_date', '-history_id')
+
+    BenchmarkObject.history = HistoricalBenchmarkObject.objects
+    _models['models'] = (BenchmarkObject, HistoricalBenchmarkObject)
+    return _models['models']
+
+
+def create_tables(model, historical_model):
+    """Creates the synthetic tables directly with the schema editor - the tests do this in their database"""
+    from django.db import connection
+    with connection.schema_editor() as editor:
+        editor.create_model(model)
+        editor.create_model(historical_model)
+
+
+def build_models():
+    """The synthetic models in a freshly migrated database"""
+    from django.core.management import call_command
+    model, historical_model = get_models()
+    call_command('migrate', verbosity=0)
+    create_tables(model, historical_model)
+    return model, historical_model
+
+
+def populate(model, historical_model, objects, versions, seed=0):
+    """objects rows each with versions history rows spread over the last year"""
+    from django.utils.timezone import now
+    random.seed(seed)
+    start = now() - datetime.timedelta(days=365)
+    batch, history = [], []
+    for pk in range(1, objects + 1):
+        created = start + datetime.timedelta(seconds=random.randint(0, 86400 * 30))
+        values = dict(name="Object {}".format(pk), code=random.choice(["{:05d}".format(pk), str(pk), ""]),
+                      amount=decimal.Decimal(random.randint(0, 10 ** 6)) / 100, count=random.randint(0, 100),
+                      created=created)
+        batch.append(model(id=pk, **values))
+        for version in range(versions):
+            history.append(historical_model(
+                id=pk, history_type='+' if version == 0 else '~',
+                history_date=created + datetime.timedelta(days=version, seconds=random.randint(0, 3600)),
+                **values))
+        if len(history) >= 5000:
+            model.objects.bulk_create(batch)
+            historical_model.objects.bulk_create(history)
+            batch, history = [], []
+    model.objects.bulk_create(batch)
+    historical_model.objects.bulk_create(history)
+
+
+class StubSplunkServer(ThreadingMixIn, HTTPServer):
+    """Just enough of the Splunk REST API and HEC for the collector - every search finishes right away.
+
+    The tests also use it - session keys in expired_keys get a 401 and the next hec_failures HEC posts a 503.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubSplunkHandler)
+        self.requests = 0
+        self.searches = 0
+        self.events = 0
+        self.logins = 0
+        self.batches = 0
+        self.acks = 0
+        self.expired_keys = set()
+        self.hec_failures = 0
+        self.handlers = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def process_request(self, request, client_address):
+        """A (daemon) thread per connection - kept so we can hang up on it"""
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self.handlers.append((request, thread))
+        thread.start()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        # Handler threads wait on keep-alive connections - hang up so they finish before the interpreter does
+        for request, thread in self.handlers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+        self.server_close()
+
+
+class StubSplunkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data, status_code=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.requests += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urlparse(self.path).path
+        if path.endswith('/auth/login'):
+            self.server.logins += 1
+            return self.reply({'sessionKey': 'benchmark{}'.format(self.server.logins)})
+        if path.startswith('/services/collector/ack'):
+            self.server.acks += 1
+            return self.reply({'acks': dict([(str(ack_id), True) for ack_id in json.loads(body)['acks']])})
+        if path.startswith('/services/collector'):
+            if self.server.hec_failures:
+                self.server.hec_failures -= 1
+                return self.reply({'text': 'Server is busy', 'code': 9}, 503)
+            self.server.batches += 1
+            self.server.events += len(body.splitlines())
+            return self.reply({'text': 'Success', 'code': 0, 'ackId': self.server.batches})
+        if self.is_expired():
+            return self.reply({'messages': [{'type': 'WARN', 'text': 'call not properly authenticated'}]}, 401)
+        if path.endswith('/search/jobs'):
+            self.server.searches += 1
+            return self.reply({'sid': 'sid{}'.format(self.server.searches)}, 201)
+        return self.reply({})
+
+    def is_expired(self):
+        session_key = (self.headers.get('Authorization') or '').replace('Splunk ', '')
+        return session_key in self.server.expired_keys
+
+    def do_GET(self):
+        self.server.requests += 1
+        path = urlparse(self.path).path
+        if self.is_expired():
+            return self.reply({'messages': [{'type': 'WARN', 'text': 'call not properly authenticated'}]}, 401)
+        if path.endswith('/results'):
+            return self.reply({'results': []})
+        return self.reply({'entry': [{'content': {'dispatchState': 'DONE', 'isDone': True, 'isFailed': False}}]})
+
+
+class Phase(object):
+    """Times a block - wall time, SQL queries and peak memory (per phase when tracing, else the process)"""
+
+    def __init__(self, report, name, trace_memory=False):
+        self.report = report
+        self.name = name
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.rows = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.queries = CaptureQueriesContext(connection)
+        self.queries.__enter__()
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.time() - self.start
+        self.queries.__exit__(*args)
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        elif resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.report[self.name] = OrderedDict([
+            ('seconds', round(self.seconds, 4)), ('rows', self.rows),
+            ('rows_per_sec', round(self.rows / self.seconds, 1) if self.seconds else None),
+            ('queries', len(self.queries)), ('peak_kb', peak), ('bytes', self.bytes)])
+
+
+def run(objects=1000, versions=5, sink='file', chunk_size=None, batch_size=None, detection=None, deletes=None,
+        trace_memory=False):
+    """Runs each collector phase against freshly generated data - returns an OrderedDict report"""
+    configure()
+    from django_splunk_analytics.data_model import HistoricalAnalyticsCollector
+    from django_splunk_analytics.utils import SplunkRequest, SplunkHECSender, RotatingFileSink
+
+    model, historical_model = build_models()
+    populate(model, historical_model, objects, versions)
+
+    class BenchmarkCollector(HistoricalAnalyticsCollector):
+        fields = ('pk', 'name', 'code', 'amount', 'count', 'created')
+
+    BenchmarkCollector.model = model
+    for attr, value in [('chunk_size', chunk_size), ('bookkeeping_batch_size', batch_size),
+                        ('change_detection', detection)]:
+        if value:
+            setattr(BenchmarkCollector, attr, value)
+
+    report = OrderedDict()
+    output_directory = tempfile.mkdtemp()
+    with StubSplunkServer() as server:
+        collector = BenchmarkCollector()
+        collector.splunk_req = SplunkRequest(scheme='http', host='127.0.0.1', port=server.server_port,
+                                             poll_interval=0.01)
+        collector.splunk_ready = True
+        collector.lock()
+        try:
+            with Phase(report, 'get_actions', trace_memory) as phase:
+                add_pks, update_pks, delete_pks = collector.get_actions()
+                phase.rows = len(add_pks) + len(update_pks) + len(delete_pks)
+
+            with Phase(report, 'get_values', trace_memory) as phase:
+                values = collector.get_values(add_pks)
+                phase.rows = len(values)
+
+            with Phase(report, 'get_historical_attributes', trace_memory) as phase:
+                phase.rows = len(collector.get_historical_attributes(add_pks))
+
+            with Phase(report, 'dump_result', trace_memory) as phase:
+                results = ["{}\n".format(collector.dump_result(item)) for item in values]
+                phase.rows = len(results)
+                phase.bytes = sum([len(x) for x in results])
+
+            with Phase(report, 'sink_{}'.format(sink), trace_memory) as phase:
+                if sink == 'hec':
+                    output = SplunkHECSender(scheme='http', host='127.0.0.1', port=server.server_port)
+                elif sink == 'file':
+                    output = RotatingFileSink(output_directory, collector.source)
+                else:
+                    output = open(os.devnull, 'w')
+                for result in results:
+                    output.write(result)
+                output.close()
+                phase.rows = len(results)
+                phase.bytes = report['dump_result']['bytes']
+
+            with Phase(report, 'bookkeeping', trace_memory) as phase:
+                changes = [(item['pk'], item['historical_last_change_date'], None) for item in values]
+                for index in range(0, len(changes), collector.bookkeeping_batch_size):
+                    collector.record_changes(changes[index:index + collector.bookkeeping_batch_size])
+                phase.rows = len(changes)
+
+            with Phase(report, 'delete_items', trace_memory) as phase:
+                delete_pks = add_pks[:deletes if deletes is not None else len(add_pks)]
+                requests = server.requests
+                collector.delete_items(delete_pks)
+                phase.rows = len(delete_pks)
+                report['delete_items_http_requests'] = server.requests - requests
+        finally:
+            collector.unlock(advance=False)
+            shutil.rmtree(output_directory, True)
+    return report
+
+
+def main(args):
+    """Main - $<description>$"""
+    logging.basicConfig(
+        level=logging.WARNING, datefmt="%H:%M:%S", stream=sys.stdout,
+        format="%(asctime)s %(levelname)s [%(filename)s] (%(name)s) %(message)s")
+
+    report = run(objects=args.objects, versions=args.versions, sink=args.sink, chunk_size=args.chunk_size,
+                 batch_size=args.batch_size, detection=args.detection, deletes=args.deletes,
+                 trace_memory=args.memory)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print("{:<28} {:>9} {:>9} {:>12} {:>8} {:>10}".format(
+        'phase', 'seconds', 'rows', 'rows/sec', 'queries', 'peak KB'))
+    for name, data in report.items():
+        if isinstance(data, dict):
+            print("{:<28} {seconds:>9} {rows:>9} {rows_per_sec:>12} {queries:>8} {peak_kb:>10}".format(name, **data))
+    print("delete_items HTTP requests: {}".format(report.get('delete_items_http_requests')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the collector pipeline on synthetic history")
+    parser.add_argument('-n', dest='objects', help="Number of objects", type=int, default=1000)
+    parser.add_argument('-m', dest='versions', help="History versions per object", type=int, default=5)
+    parser.add_argument('-s', dest='sink', help="Sink to measure", choices=['file', 'hec', 'null'], default='file')
+    parser.add_argument('-d', dest='deletes', help="Number of pks to delete (default all)", type=int)
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int)
+    parser.add_argument('--batch-size', dest='batch_size', type=int)
+    parser.add_argument('--detection', dest='detection', choices=['database', 'memory'])
+    parser.add_argument('--memory', dest='memory', help="Trace peak memory per phase", action='store_true')
+    parser.add_argument('--json', dest='json', help="Print the report as json", action='store_true')
+    sys.exit(main(parser.parse_args()))
@@ -3,28 +3,52 @@
 
 from __future__ import unicode_literals
 from __future__ import print_function
+from __future__ import absolute_import
 
-import argparse
+import calendar
 import decimal
+import functools
+import hashlib
 import json
 import logging
+import math
 
 import datetime
+import multiprocessing
 import os
 import re
+import time
 
 import sys
 from collections import OrderedDict
+from contextlib import contextmanager
 
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+from multiprocessing.pool import ThreadPool
+
+from django.apps import apps as django_apps
+from django.conf import settings
 from django.contrib.admin.options import get_content_type_for_model
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import connections, router, transaction
+from django.db.models import Aggregate, Case, When, Value, CharField, DateTimeField, Min, Max, Count, Q, F
+from django.utils import six
+from django.utils.module_loading import import_string
 from django.utils.timezone import now
-from django_splunk_analytics.utils import SplunkRequest
+from django_splunk_analytics.metrics import RunReport, NULL_REPORT
+from django_splunk_analytics.signals import track_model_changes
+from django_splunk_analytics.utils import SplunkError, SplunkRequest, SplunkSessionCache, SplunkSearchJobs, \
+    RotatingFileSink, chunked
 
 try:
-    from .models import AnalyticsChanges, AnalyticsModelTracker
+    from .models import AnalyticsChanges, AnalyticsModelTracker, AnalyticsChangeQueue, AnalyticsCatchUpShard
 except ValueError:
     sys.path.append(os.path.abspath("."))
-    from django_splunk_analytics.models import AnalyticsChanges, AnalyticsModelTracker
+    from django_splunk_analytics.models import AnalyticsChanges, AnalyticsModelTracker, AnalyticsChangeQueue, \
+        AnalyticsCatchUpShard
 
     __author__ = 'Steven Klass'
 __date__ = '1/12/17 11:38'
@@ -48,17 +72,171 @@ def splunk_default(obj):
         return obj.isoformat()
     raise TypeError
 
+
+def splunk_dumps(data):
+    """Serialize with simplejson when it's installed - the arguments keep it byte for byte with json"""
+    if simplejson is not None:
+        return simplejson.dumps(data, default=splunk_default, use_decimal=False)
+    return json.dumps(data, default=splunk_default, sort_keys=False)
+
+
+def clean_value(value):
+    """Strings that look like numbers become numbers and empties go away"""
+    if isinstance(value, basestring):
+        if value.startswith("00"):
+            pass
+        elif INTS.search(value):
+            value = int(value)
+        elif NUMS.search(value):
+            value = float(value)
+        elif not len(value):
+            value = None
+    elif isinstance(value, (list, tuple)):
+        if not len(value):
+            value = None
+        else:
+            value = [clean_value(v) for v in value]
+    return value
+
+
+def clean_datetime(value):
+    return value.isoformat() if isinstance(value, (datetime.datetime, datetime.date)) else clean_value(value)
+
+
+def clean_decimal(value):
+    return float(value) if isinstance(value, decimal.Decimal) else clean_value(value)
+
+
+UPSERT_SQL = {
+    'postgresql': "INSERT INTO {table} (content_type_id, object_id, last_updated, digest) VALUES {values} "
+                  "ON CONFLICT (content_type_id, object_id) DO UPDATE "
+                  "SET last_updated = EXCLUDED.last_updated, digest = EXCLUDED.digest",
+    'sqlite': "INSERT INTO {table} (content_type_id, object_id, last_updated, digest) VALUES {values} "
+              "ON CONFLICT (content_type_id, object_id) DO UPDATE "
+              "SET last_updated = excluded.last_updated, digest = excluded.digest",
+    'mysql': "INSERT INTO {table} (content_type_id, object_id, last_updated, digest) VALUES {values} "
+             "ON DUPLICATE KEY UPDATE last_updated = VALUES(last_updated), digest = VALUES(digest)",
+}
+
+
+def get_event_version(date):
+    """A version which orders the events for a pk - microseconds since the epoch"""
+    return calendar.timegm(date.utctimetuple()) * 1000000 + date.microsecond
+
+
+def get_lock_stamp():
+    """Lock dates are compared for equality - whole seconds so every backend stores them exactly"""
+    return now().replace(microsecond=0)
+
+
+def get_upsert_sql(connection):
+    """The native upsert for this backend if it has one (ON CONFLICT needs SQLite 3.24 / PostgreSQL 9.5)"""
+    if connection.vendor == 'sqlite' and connection.Database.sqlite_version_info < (3, 24, 0):
+        return None
+    if connection.vendor == 'postgresql' and connection.pg_version < 90500:
+        return None
+    return UPSERT_SQL.get(connection.vendor)
+
+
+def get_batch_size(connection, batch_size, params_per_row=1):
+    """batch_size capped so a statement binding params_per_row for each row stays under the backend's
+    parameter limit (i.e. SQLite's 999 before 3.32)"""
+    limit = connection.ops.bulk_batch_size(['param'] * params_per_row, [None] * batch_size)
+    return max(1, min(batch_size, limit))
+
+
+# How a value gets cleaned based on its kind - None means it is passed through untouched
+VALUE_CLEANERS = {'raw': None, 'datetime': clean_datetime, 'decimal': clean_decimal, 'string': clean_value}
+
+FIELD_KINDS = {
+    'AutoField': 'raw', 'BigAutoField': 'raw', 'IntegerField': 'raw', 'BigIntegerField': 'raw',
+    'SmallIntegerField': 'raw', 'PositiveIntegerField': 'raw', 'PositiveSmallIntegerField': 'raw',
+    'BooleanField': 'raw', 'NullBooleanField': 'raw', 'FloatField': 'raw',
+    'DecimalField': 'decimal', 'DateTimeField': 'datetime', 'DateField': 'datetime',
+}
+
+
+class RelatedList(object):
+    """Every value of lookup across a to-many relation as a list - i.e. RelatedList('subdivision__name')"""
+
+    def __init__(self, lookup, distinct=True, order_by=None):
+        self.lookup = lookup
+        self.distinct = distinct
+        self.order_by = order_by or ('pk', lookup)
+
+
 class HistoricalAnalyticsCollector(object):
+    # The model class or its 'app_label.ModelName' - a label is only resolved when we are instantiated
     model = None
     fields = ('pk',)
     field_map = OrderedDict()
     field_methods = ['get_historical_attributes']
+    # Related data by output name - a lookup string ('builder__name') for FK traversals, an aggregate
+    # (Count('subdivision')) or a RelatedList.  Each costs a fixed number of queries per chunk of pks.
+    related_fields = OrderedDict()
+    # Kinds ('raw', 'datetime', 'decimal', 'string') for keys which don't come from a model field
+    field_kinds = {
+        'historical_create_date': 'datetime', 'historical_last_change_date': 'datetime',
+        'historical_total_changes': 'raw', 'historical_delta_days': 'raw', 'historical_average_days': 'raw',
+    }
     simple_history_attribute_name = 'history'
     splunk_timestamp_field = 'historical_last_change_date'
 
     search_quantifiers = None
 
-    def __init__(self, reset=False, max_count=None):
+    # How we work out add / update / delete actions - 'database' (subqueries) or 'memory' (set math)
+    change_detection = 'database'
+    # Where changes come from - 'history' scans the history table, 'queue' drains AnalyticsChangeQueue
+    change_source = 'history'
+    # Max number of queue entries drained per run
+    queue_batch_size = 10000
+    # Page through history on (history_date, history_id), checkpointing after each page - None is one pass
+    history_page_size = None
+    # Build a RunReport of each analyze() - emit_metrics also writes it to the sink as its own event and
+    # every metrics_hooks callable gets the report dict
+    instrument = False
+    emit_metrics = False
+    metrics_hooks = []
+
+    # Skip the Splunk delete and re-add of an update whose event would come out identical to the one
+    # we last emitted.  digest_exclude are output names left out of the digest - the history attributes
+    # move on every save so an event which only differs in those is not considered changed.
+    suppress_unchanged = False
+    digest_exclude = ('timestamp', 'historical_last_change_date', 'historical_total_changes',
+                      'historical_delta_days', 'historical_average_days', 'event_version')
+
+    # How changes land in Splunk - 'replace' deletes the old event and adds the new one, 'append' never
+    # deletes: every change is a new event carrying version_field and deletes are tombstone events with
+    # deleted_field set.  Search the latest state with the macros from get_macros().
+    event_mode = 'replace'
+    version_field = 'event_version'
+    deleted_field = 'event_deleted'
+
+    # Number of pks we pull values and field methods for at a time - capped by get_chunk_size() to what
+    # the database will take in one IN list
+    chunk_size = 1000
+    # Number of AnalyticsChanges rows we upsert per transaction in add_items - each statement is capped
+    # further by get_batch_size() to stay under the database's parameter limit
+    bookkeeping_batch_size = 1000
+    # Buffer size (bytes) used for the output file
+    output_buffer_size = 1024 * 1024
+    # A lock older than this is considered abandoned and can be taken over
+    lock_expiry = datetime.timedelta(hours=6)
+    # Max pks per Splunk delete search and how many of those searches we run at once
+    delete_chunk_size = 500
+    delete_concurrency = 4
+    # Number of pk range shards catch_up() splits the backlog into and the worker processes it runs
+    catch_up_shards = 8
+    catch_up_workers = 4
+    # Database alias for the heavy reads (history scans, values, history aggregates) - i.e. a replica.
+    # Defaults to settings.SPLUNK_ANALYTICS_READ_DATABASE else wherever the router sends reads of model.
+    # Our bookkeeping is always read and written on the database AnalyticsChanges is written to.
+    read_database = None
+    # Reading from another database we leave history newer than its replay position less this for the
+    # next run - covers replication lag and transactions committing out of history_date order
+    replica_lag = datetime.timedelta(minutes=5)
+
+    def __init__(self, reset=False, max_count=None, sink=None):
         self.last_look = None
         self.locked = False
         self.add_pks = []
@@ -66,21 +244,53 @@ class HistoricalAnalyticsCollector(object):
         self.delete_pks = []
         self._existing_record_ids = []
         self.splunk_ready = False
-        self.skip_locks = True
+        self.skip_locks = False
         self.reset = reset
         self.output_file = None
+        self.output_directory = None
+        self.sink = sink
         self.max_count = max_count
+        self._serialization_plan = None
+        self.queue_snapshot = None
+        self.queue_entries = None
+        self.report = NULL_REPORT
+        self.suppressed_count = 0
+        self.shard = None
+        self.read_horizon = None
+        if isinstance(self.model, six.string_types):
+            self.model = django_apps.get_model(self.model)
 
         err_msg = "Missing attribute %r on model" % self.simple_history_attribute_name
         assert hasattr(self.model, self.simple_history_attribute_name), err_msg
 
     def get_queryset(self):
-        return self.historical_model.all()
+        return self.historical_model.using(self.read_using).all()
 
     @property
     def historical_model(self):
         return getattr(self.model, self.simple_history_attribute_name)
 
+    @property
+    def read_using(self):
+        return self.read_database or getattr(settings, 'SPLUNK_ANALYTICS_READ_DATABASE', None) or \
+            router.db_for_read(self.model)
+
+    @property
+    def write_using(self):
+        return router.db_for_write(AnalyticsChanges)
+
+    def get_read_horizon(self):
+        """The newest history_date we can safely take from the read database - None when it's the primary"""
+        if self.read_using == self.write_using:
+            return None
+        position = None
+        connection = connections[self.read_using]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_last_xact_replay_timestamp()")
+                position = cursor.fetchone()[0]
+        return min(position or now(), now()) - self.replica_lag
+
     @property
     def content_type(self):
         return get_content_type_for_model(self.model)
@@ -90,38 +300,95 @@ class HistoricalAnalyticsCollector(object):
         return self.model._meta.verbose_name.title()
 
     def lock(self):
+        """Atomically flips the tracker to In-Process - a lock older than lock_expiry is taken over"""
         prior_date = now() - datetime.timedelta(days=365 * 100)
-        try:
-            self.last_look = AnalyticsModelTracker.objects.get(
-                content_type=self.content_type)
-        except AnalyticsModelTracker.DoesNotExist:
-            self.last_look = AnalyticsModelTracker.objects.create(
-                content_type=self.content_type, last_updated=prior_date, state=0)
-        else:
-            if self.last_look.state == 0:
-                if not self.skip_locks:
-                    raise RuntimeError("Already processing")
-            if self.reset:
-                log.warning("Resetting {}".format(self.verbose_name))
-                AnalyticsChanges.objects.filter(content_type=self.content_type).delete()
-                self.last_look.last_updated = prior_date
-            self.last_look.state = 0
-            self.last_look.save()
+        self.last_look, _created = AnalyticsModelTracker.objects.using(self.write_using).get_or_create(
+            content_type=self.content_type,
+            defaults={'last_updated': prior_date, 'state': AnalyticsModelTracker.READY})
 
+        trackers = AnalyticsModelTracker.objects.using(self.write_using).filter(pk=self.last_look.pk)
+        if not self.skip_locks:
+            stale_date = now() - self.lock_expiry
+            trackers = trackers.filter(~Q(state=AnalyticsModelTracker.IN_PROCESS) |
+                                       Q(lock_date__isnull=True) | Q(lock_date__lt=stale_date))
+        if not trackers.update(state=AnalyticsModelTracker.IN_PROCESS, lock_date=get_lock_stamp()):
+            raise RuntimeError("Already processing")
+        self.last_look.refresh_from_db()
         self.locked = True
+        self.read_horizon = self.get_read_horizon()
+
+        if self.reset:
+            log.warning("Resetting {}".format(self.verbose_name))
+            self.checkpoint(prior_date, None)
+            self.clear_changes()
+
+    def clear_changes(self):
+        """Removes our AnalyticsChanges a chunk at a time rather than in one giant delete"""
+        changes = AnalyticsChanges.objects.using(self.write_using).filter(content_type=self.content_type)
+        batch_size = get_batch_size(connections[self.write_using], self.bookkeeping_batch_size)
+        while True:
+            pks = list(changes.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            AnalyticsChanges.objects.using(self.write_using).filter(pk__in=pks).delete()
+
+    def get_own_tracker(self):
+        """Our tracker - only while the lock_date we stamped is still on it (nobody took the lock over)"""
+        return AnalyticsModelTracker.objects.using(self.write_using).filter(
+            pk=self.last_look.pk, lock_date=self.last_look.lock_date)
+
+    def heartbeat(self, **kwargs):
+        """Re-stamps our lock so a long run isn't taken for abandoned - raises if it already was"""
+        lock_date = get_lock_stamp()
+        if not self.get_own_tracker().update(lock_date=lock_date, **kwargs):
+            raise RuntimeError("{} lock was taken over".format(self.verbose_name))
+        self.last_look.lock_date = lock_date
 
-    def unlock(self):
-        """Sets our last look and open the db"""
-        last_change = AnalyticsChanges.objects.filter(content_type=self.content_type).order_by('last_updated').last()
-        self.last_look.state = 0
-        self.last_look.last_updated = last_change.last_updated
-        self.last_look.save()
+    def checkpoint(self, last_updated, last_history_id):
+        """Saves our (history_date, history_id) watermark"""
+        self.heartbeat(last_updated=last_updated, last_history_id=last_history_id)
+        self.last_look.last_updated = last_updated
+        self.last_look.last_history_id = last_history_id
+        log.debug("%s checkpointed at %s (%s)", self.verbose_name, last_updated, last_history_id)
+
+    def unlock(self, advance=True):
+        """Sets our last look and open the db - pass advance=False to release without moving the last look"""
+        if advance:
+            last_updated = AnalyticsChanges.objects.using(self.write_using).filter(
+                content_type=self.content_type).aggregate(last_updated=Max('last_updated'))['last_updated']
+            if last_updated and self.read_horizon is not None:
+                # Attributes come from an object's whole history - never past what the scan could see
+                last_updated = min(last_updated, self.read_horizon)
+            if last_updated:
+                self.last_look.last_updated = last_updated
+                self.last_look.last_history_id = None
+        released = self.get_own_tracker().update(
+            state=AnalyticsModelTracker.READY, lock_date=None,
+            last_updated=self.last_look.last_updated, last_history_id=self.last_look.last_history_id)
+        if not released:
+            log.warning("%s lock was taken over by another run - leaving it alone", self.verbose_name)
+        self.last_look.state = AnalyticsModelTracker.READY
+        self.last_look.lock_date = None
         self.locked = False
 
+    def get_history_since_last_look(self):
+        """History after our (history_date, history_id) watermark"""
+        last_updated, last_history_id = self.last_look.last_updated, self.last_look.last_history_id
+        history = self.get_queryset()
+        if self.read_horizon is not None:
+            history = history.filter(history_date__lte=self.read_horizon)
+        if self.shard is not None:
+            history = history.filter(id__gte=self.shard.start_id, id__lte=self.shard.end_id,
+                                     history_date__lte=self.shard.history_date)
+        if last_history_id is None:
+            return history.filter(history_date__gt=last_updated)
+        return history.filter(Q(history_date__gt=last_updated) |
+                              Q(history_date=last_updated, history_id__gt=last_history_id))
+
     def get_historical_change_delete_pks(self):
         """This will collect a list of changes since we last looked at the data"""
         assert self.locked, "You need to lock the db first"
-        historical_changes = self.get_queryset().filter(history_date__gt=self.last_look.last_updated)
+        historical_changes = self.get_history_since_last_look()
         deletes = historical_changes.filter(history_type="-")
         historical_deletes = list(set(deletes.values_list('id', flat=True)))
 
@@ -131,12 +398,15 @@ class HistoricalAnalyticsCollector(object):
         return historical_changes, historical_deletes
 
     def get_accounted_pks(self):
-        return AnalyticsChanges.objects.filter(content_type=self.content_type).values_list('object_id', flat=True)
+        return AnalyticsChanges.objects.using(self.write_using).filter(
+            content_type=self.content_type).values_list('object_id', flat=True)
 
     @property
     def splunk(self):
         if not self.splunk_ready:
-            self.splunk_req = SplunkRequest()
+            session_cache = getattr(settings, 'SPLUNK_ANALYTICS_SESSION_CACHE', None)
+            self.splunk_req = SplunkRequest(
+                session_cache=SplunkSessionCache(session_cache) if session_cache else None)
             self.splunk_ready = True
         return self.splunk_req
 
@@ -144,117 +414,462 @@ class HistoricalAnalyticsCollector(object):
     def search_quantifier(self):
         data = ""
         if self.search_quantifiers:
-            data = self.search_quantifier
+            data = self.search_quantifiers
         return data + " model={}".format(self.model._meta.model_name)
 
+    def get_delete_query(self, delete_pks):
+        ids = ",".join(["{}".format(x) for x in delete_pks])
+        return "{} id IN ({}) | delete".format(self.search_quantifier, ids)
+
     def delete_items(self, delete_pks):
+        """Deletes in chunks of delete_chunk_size running up to delete_concurrency searches at once"""
         if not len(delete_pks):
-            return
-        ids = " OR ".join(["id={}".format(x) for x in delete_pks])
-        delete_query = "{} ({}) | delete".format(self.search_quantifier, ids)
-        search_id = self.splunk.create_search(delete_query)
-        return self.splunk.get_search_status(search_id, wait_for_results=True)
+            return []
+        jobs = SplunkSearchJobs(self.splunk, max_concurrent=self.delete_concurrency, fetch_results=False)
+        chunks = list(chunked(delete_pks, self.delete_chunk_size))
+        for index, pks in enumerate(chunks):
+            jobs.submit(self.get_delete_query(pks), key=index)
+
+        results = []
+        for index, search_id, _results, error in jobs.as_completed():
+            results.append(OrderedDict([('chunk', index), ('pks', chunks[index]), ('sid', search_id), ('error', error)]))
+            if error:
+                log.error("%s unable to delete chunk %d (sid %s) - %s", self.verbose_name, index, search_id, error)
+        results.sort(key=lambda x: x['chunk'])
+        log.info("%s deleted %d items in %d searches with %d failures", self.verbose_name, len(delete_pks),
+                 len(results), len([x for x in results if x['error']]))
+        return results
 
     def get_actions(self):
         assert self.locked, "You need to lock the db first"
 
+        if self.change_source == 'queue':
+            self.queue_snapshot = self.read_horizon or now()
+        with self.report.phase('get_actions'):
+            if self.change_source == 'queue' and not self.reset and self.shard is None:
+                add_pks, update_pks, delete_pks = self.get_queue_actions()
+            elif self.change_detection == 'memory':
+                add_pks, update_pks, delete_pks = self.get_memory_actions()
+            else:
+                add_pks, update_pks, delete_pks = self.get_database_actions()
+        self.count_actions(add_pks, update_pks, delete_pks)
+
+        log.info("%s identified %d add actions, %d update actions and %d delete actions",
+                  self.verbose_name, len(add_pks), len(update_pks), len(delete_pks))
+
+        return (add_pks, update_pks, delete_pks)
+
+    def get_memory_actions(self):
+        """Pulls every accounted pk and does the set math in python"""
         historical_change_pks, historical_delete_pks = self.get_historical_change_delete_pks()
+        accounted_pks = set(self.get_accounted_pks())
+
+        delete_pks = list(accounted_pks.intersection(set(historical_delete_pks)))
+        update_pks = list(accounted_pks.intersection(set(historical_change_pks)))
+        add_pks = list(set(historical_change_pks) - set(update_pks))
+        return (add_pks, update_pks, delete_pks)
+
+    def get_database_actions(self):
+        """Anti-joins the history against AnalyticsChanges so we only ever pull back the delta"""
+        historical_changes = self.get_history_since_last_look().order_by()
+        deletes = historical_changes.filter(history_type="-").values('id')
+        changes = historical_changes.exclude(history_type="-").exclude(id__in=deletes)
+        changes = changes.values_list('id', flat=True).distinct()
         accounted_pks = self.get_accounted_pks()
 
-        delete_pks = list(set(accounted_pks).intersection(set(historical_delete_pks)))
-        update_pks = list(set(accounted_pks).intersection(set(historical_change_pks)))
-        add_pks = list(set(historical_change_pks) - set(self.update_pks))
+        if self.read_using != self.write_using:
+            # Our bookkeeping lives on another database - no subqueries, look the history pks up there
+            change_pks = set(changes)
+            historical_delete_pks = set(deletes.values_list('id', flat=True))
+            accounted = set()
+            batch_size = get_batch_size(connections[self.write_using], self.bookkeeping_batch_size)
+            for pks in chunked(change_pks | historical_delete_pks, batch_size):
+                accounted.update(accounted_pks.filter(object_id__in=pks))
+            return (list(change_pks - accounted), list(change_pks & accounted),
+                    list(historical_delete_pks & accounted))
 
-        log.info("%s identified %d add actions, %d update actions and %d delete actions",
-                  self.verbose_name, len(add_pks), len(update_pks), len(delete_pks))
+        delete_pks = list(accounted_pks.filter(object_id__in=deletes).order_by().distinct())
+        update_pks = list(changes.filter(id__in=accounted_pks))
+        add_pks = list(changes.exclude(id__in=accounted_pks))
+        return (add_pks, update_pks, delete_pks)
+
+    def get_queue_actions(self, limit=None, after=None):
+        """Takes a batch of entries off the change queue - costs what actually changed, not the history table.
+        after is the (last_updated, pk) of the last entry of the previous batch."""
+        limit = limit or min(self.queue_batch_size, self.max_count or self.queue_batch_size)
+        entries = AnalyticsChangeQueue.objects.using(self.write_using).filter(
+            content_type=self.content_type, last_updated__lte=self.queue_snapshot).order_by('last_updated', 'pk')
+        if after is not None:
+            last_updated, last_pk = after
+            entries = entries.filter(Q(last_updated__gt=last_updated) |
+                                     Q(last_updated=last_updated, pk__gt=last_pk))
+        entries = list(entries.values_list('pk', 'object_id', 'operation', 'last_updated')[:limit])
+        self.queue_entries = entries
 
+        change_pks = [object_id for _pk, object_id, op, _date in entries if op == AnalyticsChangeQueue.CHANGE]
+        historical_delete_pks = [object_id for _pk, object_id, op, _date in entries
+                                 if op == AnalyticsChangeQueue.DELETE]
+        accounted_pks = self.get_accounted_pks()
+
+        delete_pks = list(accounted_pks.filter(object_id__in=historical_delete_pks).order_by().distinct())
+        update_pks = list(accounted_pks.filter(object_id__in=change_pks).order_by().distinct())
+        add_pks = list(set(change_pks) - set(update_pks))
         return (add_pks, update_pks, delete_pks)
 
+    def process_queue(self, sink):
+        """Drains the change queue a queue_batch_size batch at a time until it's empty (up to our snapshot)
+        or max_count is reached.  A batch's entries are removed once its events are durable in the sink."""
+        self.queue_snapshot = self.read_horizon or now()
+        processed = 0
+        after = None
+        while True:
+            limit = self.queue_batch_size
+            if self.max_count:
+                limit = min(limit, self.max_count - processed)
+                if limit <= 0:
+                    break
+            with self.report.phase('get_actions'):
+                actions = self.get_queue_actions(limit, after)
+            entries = self.queue_entries
+            if not entries:
+                break
+            self.count_actions(*actions)
+            log.info("%s identified %d add actions, %d update actions and %d delete actions from %d queued",
+                     self.verbose_name, len(actions[0]), len(actions[1]), len(actions[2]), len(entries))
+            self.process_actions(*actions, sink=sink)
+            self.on_sink_commit(sink, functools.partial(self.clear_queue, [entry[0] for entry in entries]))
+            processed += len(entries)
+            after = entries[-1][3], entries[-1][0]
+            if len(entries) < limit:
+                break
+
+    def clear_queue(self, entry_pks=None):
+        """Removes the drained entries (everything up to our snapshot without entry_pks) - entries touched
+        again since we looked are left for the next run"""
+        queue = AnalyticsChangeQueue.objects.using(self.write_using).filter(
+            content_type=self.content_type, last_updated__lte=self.queue_snapshot)
+        if entry_pks is None:
+            queue.delete()
+            return
+        for pks in chunked(entry_pks, get_batch_size(connections[self.write_using], self.bookkeeping_batch_size)):
+            queue.filter(pk__in=pks).delete()
+
+    def get_history_page(self, limit, after=None):
+        """The next page of (history_date, history_id, id, history_type) after our watermark - or after the
+        (history_date, history_id) of the last page read, which may be ahead of the saved checkpoint"""
+        history = self.get_history_since_last_look().order_by('history_date', 'history_id')
+        if after is not None:
+            last_date, last_history_id = after
+            history = history.filter(Q(history_date__gt=last_date) |
+                                     Q(history_date=last_date, history_id__gt=last_history_id))
+        return list(history.values_list('history_date', 'history_id', 'id', 'history_type')[:limit])
+
+    def get_page_actions(self, page):
+        """Add, update and delete pks for a page of history - only the page's pks are looked up.  A pk
+        with history past this page is left for the page holding its last row, so an object spread
+        over many pages is only emitted once."""
+        last_date, last_history_id = page[-1][0], page[-1][1]
+        later_pks = set(self.get_history_since_last_look().filter(
+            Q(history_date__gt=last_date) | Q(history_date=last_date, history_id__gt=last_history_id),
+            id__in=list(set([pk for _date, _id, pk, _type in page]))).order_by().values_list('id', flat=True))
+
+        page = [row for row in page if row[2] not in later_pks]
+        historical_delete_pks = set([pk for _date, _id, pk, hist_type in page if hist_type == "-"])
+        historical_change_pks = set([pk for _date, _id, pk, _type in page]) - historical_delete_pks
+        accounted_pks = set(self.get_accounted_pks().filter(
+            object_id__in=list(historical_change_pks | historical_delete_pks)))
+
+        delete_pks = list(accounted_pks & historical_delete_pks)
+        update_pks = list(accounted_pks & historical_change_pks)
+        add_pks = list(historical_change_pks - accounted_pks)
+        return (add_pks, update_pks, delete_pks)
+
+    def process_history_pages(self, sink):
+        """Keyset pages through the history saving a checkpoint after each so a restart resumes there.
+        A page is checkpointed once its events are durable in the sink - for segments that's when they
+        are sealed, so the checkpoint can trail the page we are reading."""
+        processed = 0
+        after = None
+        while True:
+            limit = self.history_page_size
+            if self.max_count:
+                limit = min(limit, self.max_count - processed)
+                if limit <= 0:
+                    break
+            with self.report.phase('get_actions'):
+                page = self.get_history_page(limit, after)
+                actions = self.get_page_actions(page) if page else None
+            if not page:
+                break
+            self.count_actions(*actions)
+            self.process_actions(*actions, sink=sink)
+            after = page[-1][0], page[-1][1]
+            self.on_sink_commit(sink, functools.partial(self.checkpoint, *after))
+            processed += len(page)
+            if len(page) < limit:
+                break
+
     def get_base_values(self, pks):
         """This is the main method for getting the values - a list of dictionaries"""
+        return list(self.iter_base_values(pks))
+
+    def iter_base_values(self, pks):
+        """Yields the values for a set of pks without caching the queryset"""
         fields = self.fields
         if 'pk' not in fields:
             fields = tuple(['pk'] + list(fields))
         # Preserve the order we want.
-        return [OrderedDict([(k, x[k]) for k in fields]) for x in self.model.objects.filter(id__in=pks).values(*fields)]
+        for x in self.model.objects.using(self.read_using).filter(id__in=pks).values(*fields).iterator():
+            yield OrderedDict([(k, x[k]) for k in fields])
+
+    def get_chunk_size(self, using):
+        """chunk_size capped to the pks a single IN list can bind on the database using"""
+        return get_batch_size(connections[using], self.chunk_size)
 
     def get_values(self, add_pks):
+        return list(self.iter_values(add_pks))
 
-        values = self.get_base_values(add_pks)
-        field_method_results = self.get_field_methods(add_pks)
-        results = []
-        for item in values:
-            field_values = field_method_results.get(item.get('pk'), {})
-            item.update(field_values)
-            results.append(item)
-        return results
+    def iter_values(self, add_pks):
+        """Streams the finished records - memory is bound by chunk_size and not the table size"""
+        for pks in chunked(add_pks, self.get_chunk_size(self.read_using)):
+            with self.report.phase('field_methods'):
+                field_method_results = self.get_field_methods(pks)
+            with self.report.phase('values'):
+                values = list(self.iter_base_values(pks))
+            self.report.incr('rows_read', len(values))
+            for item in values:
+                field_values = field_method_results.get(item.get('pk'), {})
+                item.update(field_values)
+                yield item
 
-    def add_items(self, add_pks):
-
-        for item in self.get_values(add_pks):
-            result = self.dump_result(item)
-            change, create = AnalyticsChanges.objects.get_or_create(
-                content_type=self.content_type,
-                object_id=item.get('pk'), defaults={'last_updated': item['historical_last_change_date']})
-            if not create:
-                change.last_updated = item['historical_last_change_date']
-                change.save()
-            if self.output_file:
-                with open(self.output_file, "w") as outfile:
-                    outfile.write("{}\n".format(result))
-            else:
-                print("{}".format(result))
+    @property
+    def source(self):
+        return self.model._meta.model_name
+
+    def open_sink(self):
+        """Opens the output once per run - the given sink, rotating segments, a buffered file or stdout"""
+        if self.sink is not None:
+            return self.sink
+        if self.output_directory:
+            source = self.source if self.shard is None else "{}-shard{}".format(self.source, self.shard.index)
+            return RotatingFileSink(self.output_directory, source, buffer_size=self.output_buffer_size)
+        if self.output_file:
+            output_file = self.output_file
+            if self.shard is not None:
+                output_file = "{}.shard{}".format(output_file, self.shard.index)
+            return open(output_file, "a", self.output_buffer_size)
+        return sys.stdout
+
+    def close_sink(self, sink, failed=False):
+        """Done with the sink - after a failure nothing buffered is sent (it was never recorded) and a
+        problem closing it is only logged so it can't hide the error that got us here"""
+        if failed:
+            try:
+                if hasattr(sink, 'discard'):
+                    sink.discard()
+                if sink is not sys.stdout and sink is not self.sink:
+                    sink.close()
+            except Exception:
+                log.exception("%s unable to close %r after a failure", self.verbose_name, sink)
+            return
+        if sink is sys.stdout:
+            sink.flush()
+        elif sink is self.sink:
+            getattr(sink, 'seal', sink.flush)()
+        else:
+            sink.close()
+
+    @contextmanager
+    def run_sink(self):
+        """The sink for a whole run - closed at the end, dropping what was never committed on a failure"""
+        sink = self.open_sink()
+        failed = True
+        try:
+            yield sink
+            failed = False
+        finally:
+            with self.report.phase('sink', queries=False):
+                self.close_sink(sink, failed=failed)
+
+    def commit_sink(self, sink, changes):
+        """Records the bookkeeping for changes once the sink has them durably"""
+        self.on_sink_commit(sink, functools.partial(self.record_changes_phase, changes))
+
+    def on_sink_commit(self, sink, callback):
+        """Runs callback once everything written to the sink so far is durable"""
+        if hasattr(sink, 'commit'):
+            sink.commit(callback)
+        else:
+            sink.flush()
+            callback()
+
+    def record_changes_phase(self, changes):
+        with self.report.phase('bookkeeping'):
+            self.record_changes(changes)
+            if self.shard is not None:
+                AnalyticsCatchUpShard.objects.using(self.write_using).filter(pk=self.shard.pk).update(
+                    processed=F('processed') + len(changes), last_updated=now())
+
+    def record_changes(self, changes):
+        """Upserts the AnalyticsChanges bookkeeping for a batch of (object_id, last_updated, digest)"""
+        if not changes:
+            return
+        changes = OrderedDict([(pk, (last_updated, digest)) for pk, last_updated, digest in changes])
+        using = router.db_for_write(AnalyticsChanges)
+        connection = connections[using]
+        with transaction.atomic(using=using):
+            if get_upsert_sql(connection):
+                for rows in chunked(changes.items(), get_batch_size(connection, self.bookkeeping_batch_size, 4)):
+                    self.upsert_changes(connection, rows)
+                return
+
+            # The update binds a date and a digest When (two params each) plus the IN for every existing row
+            for pks in chunked(list(changes.keys()), get_batch_size(connection, self.bookkeeping_batch_size, 6)):
+                existing = AnalyticsChanges.objects.using(using).filter(
+                    content_type=self.content_type, object_id__in=pks)
+                existing_pks = set(existing.values_list('object_id', flat=True))
+
+                AnalyticsChanges.objects.using(using).bulk_create([
+                    AnalyticsChanges(content_type=self.content_type, object_id=pk, last_updated=changes[pk][0],
+                                     digest=changes[pk][1])
+                    for pk in pks if pk not in existing_pks])
+
+                if existing_pks:
+                    dates = [When(object_id=pk, then=Value(changes[pk][0])) for pk in existing_pks]
+                    digests = [When(object_id=pk, then=Value(changes[pk][1])) for pk in existing_pks]
+                    existing.filter(object_id__in=list(existing_pks)).update(
+                        last_updated=Case(*dates, default=F('last_updated'), output_field=DateTimeField()),
+                        digest=Case(*digests, default=Value(None), output_field=CharField()))
+
+    def upsert_changes(self, connection, rows):
+        """A single INSERT .. ON CONFLICT / ON DUPLICATE KEY against the (content_type, object_id) key"""
+        field = AnalyticsChanges._meta.get_field('last_updated')
+        params = []
+        for pk, (last_updated, digest) in rows:
+            params.extend([self.content_type.pk, pk, field.get_db_prep_value(last_updated, connection), digest])
+        sql = get_upsert_sql(connection).format(
+            table=connection.ops.quote_name(AnalyticsChanges._meta.db_table),
+            values=", ".join(["(%s, %s, %s, %s)"] * len(rows)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def iter_events(self, add_pks, events=None):
+        """(pk, event, last change, digest) per pk - those in events were already serialized"""
+        events = events or {}
+        for pk in add_pks:
+            if pk in events:
+                yield (pk,) + events[pk]
+        for item in self.iter_values([pk for pk in add_pks if pk not in events]):
+            with self.report.phase('serialize', queries=False):
+                data = self.serialize_result(item)
+                result = "{}\n".format(splunk_dumps(data))
+                digest = self.get_digest(data) if self.suppress_unchanged else None
+            yield item.get('pk'), result, item['historical_last_change_date'], digest
+
+    def add_items(self, add_pks, sink, events=None):
+        changes = []
+        for pk, result, last_updated, digest in self.iter_events(add_pks, events):
+            with self.report.phase('sink', queries=False):
+                sink.write(result)
+            self.report.incr('events')
+            self.report.incr('bytes', len(result))
+            changes.append((pk, last_updated, digest))
+            if len(changes) >= self.bookkeeping_batch_size:
+                self.commit_sink(sink, changes)
+                changes = []
+        self.commit_sink(sink, changes)
 
     def get_historical_attributes(self, pks):
+        """Aggregates the history in the database - one row per pk comes back"""
         results = {}
-        data = self.historical_model.filter(id__in=pks).values_list('id', 'history_date', 'history_type')
-        for pk, hist_date, hist_type in data:
-            if pk not in results:
-                results[pk] = OrderedDict([('historical_create_date', hist_date),
-                                           ('historical_last_change_date', hist_date),
-                                           ('historical_total_changes', 0),
-                                           ('historical_delta_days', 0)])
-            results[pk]['historical_total_changes'] += 1
-            if hist_date < results[pk]['historical_create_date']:
-                results[pk]['historical_create_date'] = hist_date
-            if hist_date > results[pk]['historical_last_change_date']:
-                results[pk]['historical_last_change_date'] = hist_date
-        for k, v in results.items():
-            last = v['historical_last_change_date']
-            create = v['historical_create_date']
+        data = self.historical_model.using(self.read_using).filter(id__in=pks).order_by().values('id').annotate(
+            create=Min('history_date'), last=Max('history_date'), total=Count('history_date'))
+        for row in data:
+            create, last, total = row['create'], row['last'], row['total']
             delta_days = ((((last - create).total_seconds() / 60.0) / 60.0) / 24.0)
-            results[k]['historical_delta_days'] = delta_days
-            results[k]['historical_average_days'] = delta_days / float(v['historical_total_changes'])
+            results[row['id']] = OrderedDict([('historical_create_date', create),
+                                              ('historical_last_change_date', last),
+                                              ('historical_total_changes', total),
+                                              ('historical_delta_days', delta_days),
+                                              ('historical_average_days', delta_days / float(total))])
         return results
 
+    def get_field_kind(self, name):
+        """The kind of value we get back from values() for a field on our model"""
+        try:
+            field = self.model._meta.pk if name == 'pk' else self.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.concrete and (field.many_to_one or field.one_to_one):
+            field = field.target_field
+        return FIELD_KINDS.get(field.get_internal_type(), 'string')
+
+    def get_serialization_plan(self):
+        """Works out (output name, cleaner) per key once so dump_result doesn't have to per value"""
+        if self._serialization_plan is None:
+            plan = {}
+            for name in set(['pk'] + list(self.fields) + list(self.field_kinds.keys())):
+                kind = self.field_kinds.get(name) or self.get_field_kind(name) or 'string'
+                plan[name] = (self.field_map.get(name, name), VALUE_CLEANERS[kind])
+            self._serialization_plan = plan
+        return self._serialization_plan
+
     def dump_result(self, item):
+        return splunk_dumps(self.serialize_result(item))
 
+    def serialize_result(self, item):
+        """The event for an item as an OrderedDict of output name to cleaned value"""
         data = OrderedDict([('timestamp', item.get(self.splunk_timestamp_field)), ('pk', item.get('pk'))])
+        if self.event_mode == 'append':
+            data[self.version_field] = get_event_version(item['historical_last_change_date'])
 
-        def clean_value(value):
-            if isinstance(value, basestring):
-                if value.startswith("00"):
-                    pass
-                elif INTS.search(value):
-                    value = int(value)
-                elif NUMS.search(value):
-                    value = float(value)
-                elif not len(value):
-                    value = None
-            elif isinstance(value, (list, tuple)):
-                if not len(value):
-                    value = None
-                else:
-                    value = [clean_value(v) for v in value]
-            return value
-
+        plan = self.get_serialization_plan()
         for _field, value in item.items():
-            field = self.field_map.get(_field, _field)
-            value = clean_value(value)
+            try:
+                field, cleaner = plan[_field]
+            except KeyError:
+                field, cleaner = plan.setdefault(_field, (self.field_map.get(_field, _field), clean_value))
+            if cleaner is not None:
+                value = cleaner(value)
             if value is not None:
                 data[field] = value
 
-        return json.dumps(data, default=splunk_default, sort_keys=False)
+        return data
+
+    def get_digest(self, data):
+        """A compact digest of a serialized event less the digest_exclude keys"""
+        exclude = set(self.field_map.get(name, name) for name in self.digest_exclude)
+        payload = splunk_dumps(OrderedDict([(k, v) for k, v in data.items() if k not in exclude]))
+        return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+    def drop_unchanged(self, update_pks):
+        """Splits off the updates whose digest matches the one we last emitted.  Those only get their
+        bookkeeping moved forward - the remaining (changed) pks are returned along with their events
+        (pk -> (event, last change, digest)) so add_items doesn't read and serialize them again."""
+        unchanged = []
+        events = OrderedDict()
+        for pks in chunked(update_pks, self.get_chunk_size(self.write_using)):
+            digests = dict(AnalyticsChanges.objects.using(self.write_using).filter(
+                content_type=self.content_type, object_id__in=pks).values_list('object_id', 'digest'))
+            for item in self.iter_values(pks):
+                pk = item.get('pk')
+                data = self.serialize_result(item)
+                digest = self.get_digest(data)
+                if digest == digests.get(pk):
+                    unchanged.append((pk, item['historical_last_change_date'], digest))
+                else:
+                    result = "{}\n".format(splunk_dumps(data))
+                    events[pk] = (result, item['historical_last_change_date'], digest)
+        for changes in chunked(unchanged, self.bookkeeping_batch_size):
+            self.record_changes_phase(changes)
+
+        self.suppressed_count += len(unchanged)
+        self.report.incr('suppressed', len(unchanged))
+        log.info("%s suppressed %d of %d updates with unchanged events", self.verbose_name,
+                 len(unchanged), len(update_pks))
+        # Anything iter_values didn't return (i.e. gone since) goes through the normal update path
+        unchanged_pks = set([pk for pk, _last_updated, _digest in unchanged])
+        return [pk for pk in update_pks if pk not in unchanged_pks], events
 
     def get_field_methods(self, add_pks):
 
@@ -266,58 +881,390 @@ class HistoricalAnalyticsCollector(object):
                 if k not in results:
                     results[k] = OrderedDict()
                 results[k].update(v)
+        if self.related_fields:
+            for k, v in self.get_related_fields(add_pks).items():
+                results.setdefault(k, OrderedDict()).update(v)
         return results
 
-    def analyze(self):
+    def get_related_fields(self, pks):
+        """One values() query for all the FK traversals plus one query per aggregate and RelatedList"""
+        for name, spec in self.related_fields.items():
+            if not isinstance(spec, six.string_types + (Aggregate, RelatedList)):
+                raise ImproperlyConfigured(
+                    "{} related_fields {!r} must be a lookup, an aggregate or a RelatedList not {!r}".format(
+                        self.verbose_name, name, spec))
+
+        results = {}
+        queryset = self.model.objects.using(self.read_using).filter(pk__in=pks).order_by()
+
+        lookups = OrderedDict([(name, spec) for name, spec in self.related_fields.items()
+                               if isinstance(spec, six.string_types)])
+        if lookups:
+            for row in queryset.values('pk', *lookups.values()):
+                results.setdefault(row['pk'], OrderedDict()).update(
+                    [(name, row[lookup]) for name, lookup in lookups.items()])
+
+        for name, spec in self.related_fields.items():
+            if isinstance(spec, Aggregate):
+                for row in queryset.values('pk').annotate(**{name: spec}):
+                    results.setdefault(row['pk'], OrderedDict())[name] = row[name]
+            elif isinstance(spec, RelatedList):
+                for pk in pks:
+                    results.setdefault(pk, OrderedDict())[name] = []
+                values = queryset.values_list('pk', spec.lookup).order_by(*spec.order_by)
+                if spec.distinct:
+                    values = values.distinct()
+                for pk, value in values:
+                    if value is not None:
+                        results[pk][name].append(value)
+        return results
+
+    def count_actions(self, add_pks, update_pks, delete_pks):
+        self.report.incr('adds', len(add_pks))
+        self.report.incr('updates', len(update_pks))
+        self.report.incr('deletes', len(delete_pks))
+
+    def get_tombstones(self, delete_pks):
+        """Yields the tombstone event for each deleted pk - versioned by when the delete happened"""
+        for pks in chunked(delete_pks, self.get_chunk_size(self.read_using)):
+            dates = dict(self.historical_model.using(self.read_using).filter(id__in=pks).order_by().values('id').annotate(
+                last=Max('history_date')).values_list('id', 'last'))
+            for pk in pks:
+                date = dates.get(pk) or now()
+                yield date, OrderedDict([('timestamp', date), ('pk', pk),
+                                         (self.version_field, get_event_version(date)),
+                                         (self.deleted_field, True)])
+
+    def add_tombstones(self, delete_pks, sink):
+        """Appends a tombstone event per deleted pk rather than deleting anything in Splunk"""
+        changes = []
+        for date, data in self.get_tombstones(delete_pks):
+            with self.report.phase('serialize', queries=False):
+                result = "{}\n".format(splunk_dumps(data))
+            with self.report.phase('sink', queries=False):
+                sink.write(result)
+            self.report.incr('tombstones')
+            self.report.incr('bytes', len(result))
+            changes.append((data['pk'], date, None))
+            if len(changes) >= self.bookkeeping_batch_size:
+                self.commit_sink(sink, changes)
+                changes = []
+        self.commit_sink(sink, changes)
+
+    def get_macros(self):
+        """Splunk search macros (name -> definition) giving the latest state of each pk in append mode"""
+        latest = "{} | dedup pk sortby -{}".format(self.search_quantifier.strip(), self.version_field)
+        return OrderedDict([
+            ('{}_latest'.format(self.source), "{} | where isnull({})".format(latest, self.deleted_field)),
+            ('{}_latest_with_deletes'.format(self.source), latest),
+        ])
 
+    def process_actions(self, add_pks, update_pks, delete_pks, sink):
+        events = None
+        if self.suppress_unchanged and update_pks:
+            with self.report.phase('suppress'):
+                update_pks, events = self.drop_unchanged(update_pks)
+
+        if self.event_mode == 'append':
+            add_pks = add_pks + update_pks
+            add_pks = add_pks[:self.max_count] if self.max_count else add_pks
+            with self.report.phase('add_items'):
+                self.add_items(add_pks, sink, events)
+            delete_pks = delete_pks[:self.max_count] if self.max_count else delete_pks
+            with self.report.phase('add_tombstones'):
+                self.add_tombstones(delete_pks, sink)
+            return
+
+        delete_pks = update_pks + delete_pks
+        delete_pks = delete_pks[:self.max_count] if self.max_count else delete_pks
+        with self.report.phase('delete_items'):
+            results = self.delete_items(delete_pks) or []
+        failed = [result for result in results if result['error']]
+        if failed:
+            # Re-adding would leave the old events next to the new ones - fail the run (without moving
+            # the watermark) so the next one redoes these
+            raise SplunkError("{} unable to delete {} of {} chunks ({} pks)".format(
+                self.verbose_name, len(failed), len(results), sum([len(x['pks']) for x in failed])))
+
+        add_pks = add_pks + update_pks
+        add_pks = add_pks[:self.max_count] if self.max_count else add_pks
+        with self.report.phase('add_items'):
+            self.add_items(add_pks, sink, events)
+
+    def finish_report(self, status):
+        """Completes the run report and hands it to the sink / metrics hooks"""
+        if not self.report.enabled:
+            return
+        self.report.status = status
+        for name, counter in [('http_requests', 'requests'), ('http_retries', 'retries')]:
+            value = getattr(self.splunk_req, counter, 0) if self.splunk_ready else 0
+            value += getattr(self.sink, counter, 0) if self.sink is not None else 0
+            self.report.counters[name] = value
+        data = self.report.as_dict()
+        log.info("%s run report %s", self.verbose_name, splunk_dumps(data))
+        if self.emit_metrics:
+            try:
+                self.emit_report(data)
+            except Exception:
+                # A failed run is already raising - the report must not replace that error with its own
+                if status != 'failed':
+                    raise
+                log.exception("Unable to emit the %s run report", self.verbose_name)
+        for hook in self.metrics_hooks:
+            try:
+                hook(data)
+            except Exception:
+                log.exception("Metrics hook %r failed", hook)
+
+    def emit_report(self, data):
+        """Writes the run report to its own sink as a single event"""
+        sink = self.open_sink()
+        failed = True
+        try:
+            sink.write("{}\n".format(splunk_dumps(data)))
+            failed = False
+        finally:
+            self.close_sink(sink, failed=failed)
+
+    def plan_shards(self, count):
+        """Splits the pk space of the history after our watermark into count ranges.  The shards of an
+        earlier catch-up which didn't finish are picked back up as they were."""
+        assert self.locked, "You need to lock the db first"
+        shards = AnalyticsCatchUpShard.objects.using(self.write_using).filter(content_type=self.content_type)
+        if self.reset:
+            shards.delete()
+        if not shards.exists():
+            bounds = self.get_history_since_last_look().order_by().aggregate(
+                start=Min('id'), end=Max('id'), history_date=Max('history_date'))
+            if bounds['history_date'] is None:
+                return []
+            width = int(math.ceil((bounds['end'] - bounds['start'] + 1) / float(count)))
+            AnalyticsCatchUpShard.objects.using(self.write_using).bulk_create([
+                AnalyticsCatchUpShard(
+                    content_type=self.content_type, index=index, start_id=start,
+                    end_id=min(start + width - 1, bounds['end']), history_date=bounds['history_date'],
+                    state=AnalyticsCatchUpShard.READY, last_updated=now())
+                for index, start in enumerate(range(bounds['start'], bounds['end'] + 1, width))])
+        return list(shards.order_by('index'))
+
+    def update_shard(self, state, **kwargs):
+        AnalyticsCatchUpShard.objects.using(self.write_using).filter(pk=self.shard.pk).update(
+            state=state, last_updated=now(), **kwargs)
+
+    def process_shard(self, shard_id):
+        """Works through one shard - runs in a catch-up worker under the lock catch_up() holds"""
+        self.shard = AnalyticsCatchUpShard.objects.using(self.write_using).get(pk=shard_id)
+        self.last_look = AnalyticsModelTracker.objects.using(self.write_using).get(
+            content_type=self.content_type)
+        self.locked = True
+        self.update_shard(AnalyticsCatchUpShard.IN_PROCESS, processed=0)
+        try:
+            with self.run_sink() as sink:
+                self.process_actions(*self.get_actions(), sink=sink)
+        except Exception:
+            self.update_shard(AnalyticsCatchUpShard.FAILED)
+            raise
+        finally:
+            self.locked = False
+        self.update_shard(AnalyticsCatchUpShard.COMPLETE)
+        log.info("%s completed shard %d (%d - %d)", self.verbose_name, self.shard.index,
+                 self.shard.start_id, self.shard.end_id)
+
+    def catch_up(self, shards=None, workers=None, use_processes=True, sink_factory=None):
+        """Works through the backlog with the pk space split into shards run on a pool of workers.
+
+        Each shard gets its own database connection, sink segment and bookkeeping, with its progress on
+        AnalyticsCatchUpShard.  Our watermark only moves to the end of the backlog once every shard is
+        complete - rerun after a failure and just the unfinished shards are processed.  Returns an
+        OrderedDict of shard index -> error (None on success).
+
+        A sink can't be shared by the workers - pass sink_factory (i.e. a SplunkHECSender subclass or a
+        module level function, something a process pool can pickle) and each shard makes its own.
+        """
+        if self.sink is not None and sink_factory is None:
+            raise ValueError("{} has a sink - catch_up() needs a sink_factory to give each shard its own".format(
+                self.verbose_name))
         try:
             self.lock()
         except RuntimeError as err:
             log.info("Unable to lock! - %r", err)
             return err
 
-        log.debug("Getting actions")
-        (add_pks, update_pks, delete_pks) = self.get_actions()
+        results = OrderedDict()
+        try:
+            plan = self.plan_shards(shards or self.catch_up_shards)
+            pending = OrderedDict([(shard.pk, shard.index) for shard in plan
+                                   if shard.state != AnalyticsCatchUpShard.COMPLETE])
+            if pending:
+                pool = get_pool(min(workers or self.catch_up_workers, len(pending)), use_processes)
+                attributes = {'output_file': self.output_file, 'output_directory': self.output_directory}
+                run = functools.partial(run_shard, self.__class__, attributes, sink_factory)
+                try:
+                    for shard_id, error in pool.imap_unordered(run, list(pending.keys())):
+                        results[pending[shard_id]] = error
+                        self.heartbeat()
+                finally:
+                    pool.close()
+                    pool.join()
+                results = OrderedDict(sorted(results.items()))
+        except Exception:
+            self.unlock(advance=False)
+            raise
 
-        delete_pks = update_pks + delete_pks
-        delete_pks = delete_pks[:self.max_count] if self.max_count else delete_pks
-        self.delete_items(delete_pks)
+        failed = [index for index, error in results.items() if error]
+        if plan and not failed:
+            self.last_look.last_updated = plan[0].history_date
+            self.last_look.last_history_id = None
+            AnalyticsCatchUpShard.objects.using(self.write_using).filter(content_type=self.content_type).delete()
+        elif failed:
+            log.error("%s catch up shards %s did not complete", self.verbose_name, failed)
+        self.unlock(advance=False)
+        return results
 
-        add_pks = add_pks + update_pks
-        add_pks = add_pks[:self.max_count] if self.max_count else add_pks
-        self.add_items(add_pks)
+    def analyze(self):
+
+        aliases = OrderedDict.fromkeys([self.read_using, self.write_using])
+        self.report = RunReport(self.__class__.__name__, aliases) if self.instrument else NULL_REPORT
+        try:
+            with self.report.phase('lock'):
+                self.lock()
+        except RuntimeError as err:
+            log.info("Unable to lock! - %r", err)
+            self.finish_report('locked')
+            return err
+
+        paged = self.history_page_size and self.change_source == 'history'
+        queued = self.change_source == 'queue' and not self.reset
+        try:
+            with self.run_sink() as sink:
+                if paged:
+                    self.process_history_pages(sink)
+                elif queued:
+                    self.process_queue(sink)
+                else:
+                    log.debug("Getting actions")
+                    self.process_actions(*self.get_actions(), sink=sink)
 
-        self.unlock()
+            if self.change_source == 'queue' and not queued:
+                # A reset went through the whole history - anything queued up to now is covered
+                self.clear_queue()
+        except Exception:
+            self.unlock(advance=False)
+            self.finish_report('failed')
+            raise
 
+        # Paged runs have already checkpointed their way forward
+        with self.report.phase('unlock'):
+            self.unlock(advance=not paged)
+        self.finish_report('complete')
 
-import django
-django.setup()
-from apps.community.models import Community
-class CommunityCollector(HistoricalAnalyticsCollector):
-    model = Community
+
+COLLECTORS = OrderedDict()
+
+
+COLLECTORS_LOADED = False
+
+
+def register(collector_class):
+    """Class decorator which adds a collector to the registry used by run_collectors"""
+    COLLECTORS[collector_class.__name__] = collector_class
+    if collector_class.change_source == 'queue':
+        model = collector_class.model
+        track_model_changes(django_apps.get_model(model) if isinstance(model, six.string_types) else model)
+    return collector_class
 
 
-def main(args):
-    """Main - $<description>$"""
-    logging.basicConfig(
-        level=logging.INFO, datefmt="%H:%M:%S", stream=sys.stdout,
-        format="%(asctime)s %(levelname)s [%(filename)s] (%(name)s) %(message)s")
+def get_collectors():
+    """The registry - the dotted paths in settings.SPLUNK_ANALYTICS_COLLECTORS are imported on first use
+    so importing us costs nothing.  Without the setting the project's community collector is used."""
+    global COLLECTORS_LOADED
+    if not COLLECTORS_LOADED:
+        paths = getattr(settings, 'SPLUNK_ANALYTICS_COLLECTORS', None)
+        if paths is None:
+            paths = ['django_splunk_analytics.data_model.CommunityCollector'] \
+                if django_apps.is_installed('apps.community') else []
+        for path in paths:
+            collector_class = import_string(path)
+            if COLLECTORS.get(collector_class.__name__) is not collector_class:
+                register(collector_class)
+        COLLECTORS_LOADED = True
+    return COLLECTORS
 
-    args.verbose = 4 if args.verbose > 4 else args.verbose
-    loglevel = 50 - args.verbose * 10
-    log.setLevel(loglevel)
 
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', args.settings)
+def get_macros_conf(names=None):
+    """macros.conf stanzas for the registered append mode collectors"""
+    lines = []
+    collectors = get_collectors()
+    for name in names or collectors.keys():
+        collector_class = collectors[name]
+        if collector_class.event_mode != 'append':
+            continue
+        for macro, definition in collector_class().get_macros().items():
+            lines.extend(["[{}]".format(macro), "definition = {}".format(definition), "iseval = 0", ""])
+    return "\n".join(lines)
 
-    log.debug("Starting to process community..")
-    collector = CommunityCollector()
-    collector.analyze()
 
+def run_collector(name, **kwargs):
+    """Runs a single registered collector - returns (name, error)"""
+    try:
+        result = get_collectors()[name](**kwargs).analyze()
+    except Exception as err:
+        log.exception("%s failed", name)
+        result = err
+    finally:
+        connections.close_all()
+    return name, repr(result) if isinstance(result, Exception) else None
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="$<description>$")
-    parser.add_argument('-v', dest='verbose', help="How verbose of the output",
-                        action='append_const', const=1, default=[1, 2, 3, 4, 5])
-    parser.add_argument('-y', dest='settings', help="Django Settings", action='store')
-    parser.add_argument("-n", dest='dry_run', help="Dry Run", action="store_true")
-    sys.exit(main(parser.parse_args()))
+
+def get_pool(workers, use_processes=False):
+    """A thread (or process) pool of workers"""
+    if use_processes:
+        # Forked children must not share the parent's database sockets
+        connections.close_all()
+        return multiprocessing.Pool(workers)
+    return ThreadPool(workers)
+
+
+def run_shard(collector_class, attributes, sink_factory, shard_id):
+    """Runs a single catch-up shard - returns (shard_id, error)"""
+    try:
+        sink = sink_factory() if sink_factory is not None else None
+        collector = collector_class(sink=sink)
+        for name, value in attributes.items():
+            setattr(collector, name, value)
+        collector.process_shard(shard_id)
+        if sink is not None:
+            sink.close()
+        error = None
+    except Exception as err:
+        log.exception("%s shard %s failed", collector_class.__name__, shard_id)
+        error = repr(err)
+    finally:
+        connections.close_all()
+    return shard_id, error
+
+
+def run_collectors(names=None, workers=4, use_processes=False, **kwargs):
+    """Runs the registered collectors concurrently on a thread (or process) pool of `workers`.
+
+    Each worker gets its own database connection and the per content type lock keeps two runs of
+    the same collector from overlapping.  Returns an OrderedDict of name -> error (None on success).
+    """
+    names = list(names or get_collectors().keys())
+    if not names:
+        return OrderedDict()
+    pool = get_pool(min(workers, len(names)), use_processes)
+    try:
+        results = OrderedDict(pool.map(functools.partial(run_collector, **kwargs), names))
+    finally:
+        pool.close()
+        pool.join()
+
+    for name, error in results.items():
+        if error:
+            log.error("%s did not complete - %s", name, error)
+    return results
+
+
+class CommunityCollector(HistoricalAnalyticsCollector):
+    model = 'community.Community'
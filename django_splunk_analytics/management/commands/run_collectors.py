@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""run_collectors.py: Django """
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import logging
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_splunk_analytics.data_model import get_collectors, get_macros_conf, run_collectors
+
+__author__ = 'Steven Klass'
+__date__ = '1/12/17 11:38'
+__credits__ = ['Steven Klass', ]
+
+log = logging.getLogger(__name__)
+
+LOG_LEVELS = {0: logging.ERROR, 1: logging.INFO, 2: logging.DEBUG, 3: logging.DEBUG}
+
+
+class Command(BaseCommand):
+    help = "Runs the registered Splunk analytics collectors"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', dest='collectors', help="Collector to run (default all)", action='append')
+        parser.add_argument('-w', dest='workers', help="Number of workers", type=int, default=4)
+        parser.add_argument('-p', dest='processes', help="Use processes instead of threads", action='store_true')
+        parser.add_argument('-s', dest='shards', help="Catch up with the backlog split into this many shards",
+                            type=int)
+        parser.add_argument('-m', dest='macros', help="Print macros.conf for append mode collectors",
+                            action='store_true')
+
+    def handle(self, *args, **options):
+        # Logging goes to stderr - stdout is left for the macros.conf output
+        logging.basicConfig(
+            level=LOG_LEVELS[options['verbosity']], datefmt="%H:%M:%S", stream=sys.stderr,
+            format="%(asctime)s %(levelname)s [%(filename)s] (%(name)s) %(message)s")
+
+        collectors = get_collectors()
+        names = options['collectors'] or list(collectors.keys())
+        unknown = [name for name in names if name not in collectors]
+        if unknown:
+            raise CommandError("Unknown collectors {} - registered are {}".format(
+                ", ".join(unknown), ", ".join(collectors.keys()) or "none"))
+
+        if options['macros']:
+            self.stdout.write(get_macros_conf(names))
+            return
+
+        if options['shards']:
+            results = {}
+            for name in names:
+                errors = collectors[name]().catch_up(shards=options['shards'], workers=options['workers'])
+                if isinstance(errors, Exception):
+                    # Another run holds the lock
+                    results[name] = repr(errors)
+                    continue
+                results[name] = ", ".join(["shard {} {}".format(index, error)
+                                           for index, error in errors.items() if error]) or None
+        else:
+            log.debug("Starting to process %s..", ", ".join(names))
+            results = run_collectors(names, workers=options['workers'], use_processes=options['processes'])
+
+        failed = ["{} ({})".format(name, error) for name, error in results.items() if error]
+        if failed:
+            raise CommandError("Collectors did not complete - {}".format(", ".join(failed)))
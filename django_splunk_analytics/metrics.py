@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""metrics.py: Django """
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import logging
+import time
+from collections import OrderedDict, deque
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.timezone import now
+
+__author__ = 'Steven Klass'
+__date__ = '1/12/17 11:38'
+__credits__ = ['Steven Klass', ]
+
+log = logging.getLogger(__name__)
+
+
+class QueryLog(deque):
+    """Stands in for connection.queries_log - counts every query, not just the last 9000 Django keeps"""
+
+    def __init__(self, iterable=(), maxlen=None):
+        super(QueryLog, self).__init__(iterable, maxlen)
+        self.count = 0
+
+    def append(self, query):
+        self.count += 1
+        super(QueryLog, self).append(query)
+
+
+def get_query_log(alias=DEFAULT_DB_ALIAS):
+    connection = connections[alias]
+    if not isinstance(connection.queries_log, QueryLog):
+        connection.queries_log = QueryLog(connection.queries_log, connection.queries_log.maxlen)
+    return connection.queries_log
+
+
+class Phase(object):
+    """Adds the wall time (and SQL queries on every alias the report watches) of a block to a phase"""
+
+    def __init__(self, report, name, queries=True):
+        self.report = report
+        self.name = name
+        self.queries = queries
+
+    def __enter__(self):
+        if self.queries:
+            self.watched = []
+            for alias in self.report.aliases:
+                connection, query_log = connections[alias], get_query_log(alias)
+                self.watched.append((connection, query_log, query_log.count, connection.force_debug_cursor))
+                connection.force_debug_cursor = True
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        phase = self.report.get_phase(self.name)
+        phase['seconds'] += time.time() - self.started
+        phase['calls'] += 1
+        if self.queries:
+            for connection, query_log, initial_queries, force_debug_cursor in self.watched:
+                connection.force_debug_cursor = force_debug_cursor
+                phase['queries'] += query_log.count - initial_queries
+
+
+class NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+class RunReport(object):
+    """A structured report of a collector run - per phase wall time / SQL queries plus counters.
+    Queries are counted on aliases (every configured database by default)."""
+    enabled = True
+
+    def __init__(self, name, aliases=None):
+        self.name = name
+        self.aliases = list(aliases) if aliases is not None else list(connections)
+        self.started = now()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.status = None
+
+    def get_phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = OrderedDict([('seconds', 0.0), ('queries', 0), ('calls', 0)])
+        return self.phases[name]
+
+    def phase(self, name, queries=True):
+        return Phase(self, name, queries=queries)
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        finished = now()
+        data = OrderedDict([
+            ('timestamp', finished), ('event_type', 'collector_run'), ('collector', self.name),
+            ('status', self.status), ('seconds', (finished - self.started).total_seconds())])
+        for name, phase in self.phases.items():
+            data['{}_seconds'.format(name)] = round(phase['seconds'], 6)
+            data['{}_queries'.format(name)] = phase['queries']
+        data.update(self.counters)
+        return data
+
+
+class NullRunReport(object):
+    """What collectors use when instrumentation is off - every call is a no-op"""
+    enabled = False
+
+    def phase(self, name, queries=True):
+        return NULL_PHASE
+
+    def incr(self, name, value=1):
+        pass
+
+
+NULL_REPORT = NullRunReport()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('django_splunk_analytics', '0002_analyticsmodeltracker_lock_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsChangeQueue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('operation', models.SmallIntegerField(choices=[(1, 'Change'), (2, 'Delete')])),
+                ('last_updated', models.DateTimeField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='analyticschangequeue',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_splunk_analytics', '0003_analyticschangequeue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analyticsmodeltracker',
+            name='last_history_id',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+    ]
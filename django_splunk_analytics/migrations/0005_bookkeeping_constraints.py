@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def remove_duplicates(apps, schema_editor):
+    """Keep the most recent AnalyticsChanges per object and tracker per content type"""
+    AnalyticsChanges = apps.get_model('django_splunk_analytics', 'AnalyticsChanges')
+    AnalyticsModelTracker = apps.get_model('django_splunk_analytics', 'AnalyticsModelTracker')
+
+    duplicates = AnalyticsChanges.objects.values('content_type', 'object_id').annotate(
+        count=Count('id')).filter(count__gt=1).order_by()
+    for duplicate in duplicates:
+        changes = AnalyticsChanges.objects.filter(
+            content_type=duplicate['content_type'], object_id=duplicate['object_id'])
+        keep = changes.order_by('-last_updated', '-id').first()
+        changes.exclude(id=keep.id).delete()
+
+    duplicates = AnalyticsModelTracker.objects.values('content_type').annotate(
+        count=Count('id')).filter(count__gt=1).order_by()
+    for duplicate in duplicates:
+        trackers = AnalyticsModelTracker.objects.filter(content_type=duplicate['content_type'])
+        keep = trackers.order_by('-last_updated', '-id').first()
+        trackers.exclude(id=keep.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('django_splunk_analytics', '0004_analyticsmodeltracker_last_history_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='analyticsmodeltracker',
+            name='content_type',
+            field=models.OneToOneField(to='contenttypes.ContentType'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='analyticschanges',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='analyticschanges',
+            index_together=set([('content_type', 'last_updated')]),
+        ),
+    ]
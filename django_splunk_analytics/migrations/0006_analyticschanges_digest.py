@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_splunk_analytics', '0005_bookkeeping_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analyticschanges',
+            name='digest',
+            field=models.CharField(max_length=32, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('django_splunk_analytics', '0006_analyticschanges_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsCatchUpShard',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('index', models.PositiveSmallIntegerField()),
+                ('start_id', models.PositiveIntegerField()),
+                ('end_id', models.PositiveIntegerField()),
+                ('history_date', models.DateTimeField()),
+                ('state', models.SmallIntegerField(choices=[(1, 'Ready'), (2, 'In-Process'), (3, 'Complete'), (4, 'Failed')])),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('last_updated', models.DateTimeField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='analyticscatchupshard',
+            unique_together=set([('content_type', 'index')]),
+        ),
+    ]
@@ -19,11 +19,15 @@ log = logging.getLogger(__name__)
 
 class AnalyticsModelTracker(models.Model):
     """Tracks a general model processing"""
-    content_type = models.ForeignKey(ContentType)
-    last_updated = models.DateTimeField()
-    state = models.SmallIntegerField(choices=[(1, 'Ready'), (2, 'In-Process')])
+    READY, IN_PROCESS = 1, 2
+
+    content_type = models.OneToOneField(ContentType)
+    state = models.SmallIntegerField(choices=[(READY, 'Ready'), (IN_PROCESS, 'In-Process')])
+    lock_date = models.DateTimeField(null=True, blank=True)
+    last_history_id = models.PositiveIntegerField(null=True, blank=True)
     last_updated = models.DateTimeField()
 
+
 class AnalyticsChanges(models.Model):
 
     # Enable generic foreign key to other models
@@ -31,3 +35,41 @@ class AnalyticsChanges(models.Model):
     object_id = models.PositiveIntegerField(db_index=True)
     content_object = GenericForeignKey('content_type', 'object_id')
     last_updated = models.DateTimeField()
+    # Digest of the last event we emitted for this object - lets us skip re-emitting an identical one
+    digest = models.CharField(max_length=32, null=True, blank=True)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+        index_together = ('content_type', 'last_updated')
+
+
+class AnalyticsChangeQueue(models.Model):
+    """Dirty objects captured from signals - coalesced to one row per object, the last operation wins"""
+    CHANGE, DELETE = 1, 2
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    operation = models.SmallIntegerField(choices=[(CHANGE, 'Change'), (DELETE, 'Delete')])
+    last_updated = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+
+class AnalyticsCatchUpShard(models.Model):
+    """A pk range of a sharded catch-up - the tracker only moves forward once every shard is complete"""
+    READY, IN_PROCESS, COMPLETE, FAILED = 1, 2, 3, 4
+
+    content_type = models.ForeignKey(ContentType)
+    index = models.PositiveSmallIntegerField()
+    start_id = models.PositiveIntegerField()
+    end_id = models.PositiveIntegerField()
+    # History after the tracker's watermark up to and including this date is what the shards cover
+    history_date = models.DateTimeField()
+    state = models.SmallIntegerField(choices=[(READY, 'Ready'), (IN_PROCESS, 'In-Process'),
+                                              (COMPLETE, 'Complete'), (FAILED, 'Failed')])
+    processed = models.PositiveIntegerField(default=0)
+    last_updated = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('content_type', 'index')
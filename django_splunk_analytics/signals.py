@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""signals.py: Django """
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import logging
+
+from django.contrib.admin.options import get_content_type_for_model
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_save, post_delete
+from django.utils.timezone import now
+
+from .models import AnalyticsChangeQueue
+
+__author__ = 'Steven Klass'
+__date__ = '1/12/17 11:38'
+__credits__ = ['Steven Klass', ]
+
+log = logging.getLogger(__name__)
+
+
+def queue_change(model, object_id, operation):
+    """Coalescing upsert - an object only ever has one queue row holding its latest operation"""
+    content_type = get_content_type_for_model(model)
+    queue = AnalyticsChangeQueue.objects.filter(content_type=content_type, object_id=object_id)
+    if queue.update(operation=operation, last_updated=now()):
+        return
+    try:
+        with transaction.atomic():
+            AnalyticsChangeQueue.objects.create(
+                content_type=content_type, object_id=object_id, operation=operation, last_updated=now())
+    except IntegrityError:
+        queue.update(operation=operation, last_updated=now())
+
+
+def queue_save(sender, instance, **kwargs):
+    queue_change(sender, instance.pk, AnalyticsChangeQueue.CHANGE)
+
+
+def queue_delete(sender, instance, **kwargs):
+    queue_change(sender, instance.pk, AnalyticsChangeQueue.DELETE)
+
+
+def track_model_changes(model):
+    """Queue saves and deletes on model for collectors using change_source = 'queue'.
+
+    Queryset update() / bulk_create() don't send signals - those still need a history scan (reset).
+    """
+    uid = '{}.{}'.format(model._meta.app_label, model._meta.model_name)
+    post_save.connect(queue_save, sender=model, dispatch_uid='splunk_queue_save_{}'.format(uid))
+    post_delete.connect(queue_delete, sender=model, dispatch_uid='splunk_queue_delete_{}'.format(uid))
+    log.debug("Tracking changes to %s", uid)
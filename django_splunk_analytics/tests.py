@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""tests.py: Django """
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from unittest import skipUnless
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.utils.timezone import now
+
+from django_splunk_analytics import data_model
+from django_splunk_analytics.benchmark import StubSplunkServer, create_tables, get_models, populate
+from django_splunk_analytics.data_model import HistoricalAnalyticsCollector, clean_value, splunk_default
+from django_splunk_analytics.models import AnalyticsChanges, AnalyticsModelTracker
+from django_splunk_analytics.utils import SplunkError, SplunkHECSender, SplunkRequest, SplunkSessionCache, \
+    RotatingFileSink
+
+__author__ = 'Steven Klass'
+__date__ = '1/12/17 11:38'
+__credits__ = ['Steven Klass', ]
+
+log = logging.getLogger(__name__)
+
+
+class ContentTypeCollector(HistoricalAnalyticsCollector):
+    """Just enough of a collector for the locking and bookkeeping - ContentType stands in for the model"""
+    model = ContentType
+    simple_history_attribute_name = 'objects'
+
+
+class BenchmarkCollector(HistoricalAnalyticsCollector):
+    """The benchmark's collector - over its synthetic model"""
+    model = 'django_splunk_analytics.BenchmarkObject'
+    fields = ('pk', 'name', 'code', 'amount', 'count', 'created')
+
+
+class EventSink(object):
+    """Keeps every event written to it"""
+
+    def __init__(self):
+        self.events = []
+
+    def write(self, data):
+        self.events.extend([json.loads(line) for line in data.splitlines()])
+
+    def flush(self):
+        pass
+
+
+class StubServerMixin(object):
+
+    def setUp(self):
+        super(StubServerMixin, self).setUp()
+        self.server = StubSplunkServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+
+
+class SplunkHECSenderTests(StubServerMixin, SimpleTestCase):
+
+    def get_sender(self, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        return SplunkHECSender(token='test', scheme='http', host='127.0.0.1', port=self.server.server_port,
+                               **kwargs)
+
+    def test_batches(self):
+        sender = self.get_sender(max_events=3)
+        sender.write("".join(['{{"pk": {}}}\n'.format(pk) for pk in range(7)]))
+        self.assertEqual(self.server.batches, 2)
+        sender.close()
+        self.assertEqual(self.server.batches, 3)
+        self.assertEqual(self.server.events, 7)
+        self.assertEqual((sender.events_sent, sender.batches_sent), (7, 3))
+
+    def test_max_wait(self):
+        sender = self.get_sender(max_wait=0.05)
+        sender.write('{"pk": 1}\n')
+        time.sleep(0.5)
+        self.assertEqual(self.server.events, 1)
+        self.assertEqual(sender.events, [])
+        sender.close()
+        self.assertEqual(self.server.batches, 1)
+
+    def test_no_max_wait(self):
+        sender = self.get_sender(max_events=100, max_wait=None)
+        for pk in range(5):
+            sender.write('{{"pk": {}}}\n'.format(pk))
+        self.assertEqual(self.server.batches, 0)
+        sender.close()
+        self.assertEqual((self.server.batches, self.server.events), (1, 5))
+
+    def test_retries_busy(self):
+        self.server.hec_failures = 2
+        sender = self.get_sender()
+        sender.write('{"pk": 1}\n{"pk": 2}\n')
+        sender.flush()
+        self.assertEqual(sender.retries, 2)
+        self.assertEqual(self.server.events, 2)
+
+    def test_failed_batch_is_dropped(self):
+        self.server.hec_failures = 10
+        sender = self.get_sender(max_retries=1)
+        sender.write('{"pk": 1}\n')
+        self.assertRaises(SplunkError, sender.flush)
+        self.assertEqual(sender.events, [])
+        self.assertRaises(SplunkError, sender.write, '{"pk": 2}\n')
+        sender.close()
+        self.assertEqual(self.server.events, 0)
+
+    def test_ack(self):
+        sender = self.get_sender(use_ack=True)
+        self.assertTrue(sender.channel)
+        sender.write('{"pk": 1}\n')
+        sender.flush()
+        self.assertEqual(self.server.acks, 1)
+        self.assertEqual(sender.batches_sent, 1)
+
+
+class SplunkRequestSessionTests(StubServerMixin, SimpleTestCase):
+
+    def setUp(self):
+        super(SplunkRequestSessionTests, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.session_cache = SplunkSessionCache(os.path.join(directory, 'sessions.json'))
+
+    def get_request(self):
+        return SplunkRequest(scheme='http', host='127.0.0.1', port=self.server.server_port,
+                             session_cache=self.session_cache)
+
+    def test_cached_session_key_is_reused(self):
+        first, second = self.get_request(), self.get_request()
+        self.assertEqual(first.create_search('index=test'), 'sid1')
+        self.assertEqual(second.create_search('index=test'), 'sid2')
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(second.session_key, first.session_key)
+
+    def test_expired_session_key_logs_in_again(self):
+        first, second = self.get_request(), self.get_request()
+        first.connect()
+        self.server.expired_keys.add(first.session_key)
+        self.assertEqual(second.create_search('index=test'), 'sid1')
+        self.assertEqual((self.server.logins, second.retries), (2, 1))
+        self.assertEqual(self.session_cache.get(second.cache_key), second.session_key)
+        # The first picks up the new cached key rather than logging in again itself
+        self.assertEqual(first.create_search('index=test'), 'sid2')
+        self.assertEqual(self.server.logins, 2)
+        self.assertEqual(first.session_key, second.session_key)
+
+
+class RecordChangesTests(TestCase):
+
+    def setUp(self):
+        self.collector = ContentTypeCollector()
+        self.first, self.second = now() - datetime.timedelta(days=1), now()
+
+    def assertRecorded(self):
+        self.collector.record_changes([(1, self.first, 'a'), (2, self.first, None)])
+        self.collector.record_changes([(2, self.second, 'b'), (3, self.second, None)])
+        changes = AnalyticsChanges.objects.filter(content_type=self.collector.content_type)
+        self.assertEqual(sorted(changes.values_list('object_id', 'last_updated', 'digest')), [
+            (1, self.first, 'a'), (2, self.second, 'b'), (3, self.second, None)])
+
+    @skipUnless(data_model.get_upsert_sql(connection), "No native upsert on this database")
+    def test_native_upsert(self):
+        self.assertRecorded()
+
+    def test_fallback(self):
+        get_upsert_sql = data_model.get_upsert_sql
+        data_model.get_upsert_sql = lambda connection: None
+        self.addCleanup(setattr, data_model, 'get_upsert_sql', get_upsert_sql)
+        self.assertRecorded()
+
+    def assertRecordedBatch(self):
+        self.collector.record_changes([(pk, self.first, None) for pk in range(1, 1201)])
+        self.collector.record_changes([(pk, self.second, 'b') for pk in range(601, 1801)])
+        changes = AnalyticsChanges.objects.filter(content_type=self.collector.content_type)
+        self.assertEqual(changes.count(), 1800)
+        self.assertEqual(changes.filter(last_updated=self.second, digest='b').count(), 1200)
+
+    @skipUnless(data_model.get_upsert_sql(connection), "No native upsert on this database")
+    def test_native_upsert_over_parameter_limit(self):
+        self.assertRecordedBatch()
+
+    def test_fallback_over_parameter_limit(self):
+        get_upsert_sql = data_model.get_upsert_sql
+        data_model.get_upsert_sql = lambda connection: None
+        self.addCleanup(setattr, data_model, 'get_upsert_sql', get_upsert_sql)
+        self.assertRecordedBatch()
+
+
+class LockTests(TestCase):
+
+    def get_tracker(self):
+        return AnalyticsModelTracker.objects.get(content_type=ContentTypeCollector().content_type)
+
+    def test_lock_is_exclusive(self):
+        first, second = ContentTypeCollector(), ContentTypeCollector()
+        first.lock()
+        self.assertRaises(RuntimeError, second.lock)
+        first.unlock(advance=False)
+        second.lock()
+        self.assertEqual(self.get_tracker().state, AnalyticsModelTracker.IN_PROCESS)
+
+    def test_stale_lock_is_taken_over(self):
+        first, second = ContentTypeCollector(), ContentTypeCollector()
+        first.lock()
+        stale_date = now().replace(microsecond=0) - first.lock_expiry - datetime.timedelta(minutes=1)
+        AnalyticsModelTracker.objects.filter(pk=first.last_look.pk).update(lock_date=stale_date)
+        first.last_look.lock_date = stale_date
+
+        second.lock()
+        self.assertRaises(RuntimeError, first.heartbeat)
+        first.unlock(advance=False)
+        tracker = self.get_tracker()
+        self.assertEqual((tracker.state, tracker.lock_date), (AnalyticsModelTracker.IN_PROCESS,
+                                                              second.last_look.lock_date))
+        second.unlock(advance=False)
+        self.assertEqual(self.get_tracker().state, AnalyticsModelTracker.READY)
+
+
+class BrokenSink(object):
+
+    def write(self, data):
+        raise SplunkError("Splunk is down")
+
+
+class FinishReportTests(TestCase):
+
+    def get_actions(self):
+        raise ValueError("Broken run")
+
+    def test_failed_run_keeps_its_error(self):
+        reports = []
+        collector = ContentTypeCollector(sink=BrokenSink())
+        collector.instrument = collector.emit_metrics = True
+        collector.metrics_hooks = [reports.append]
+        collector.get_actions = self.get_actions
+        self.assertRaisesMessage(ValueError, "Broken run", collector.analyze)
+        self.assertEqual([report['status'] for report in reports], ['failed'])
+        self.assertEqual(AnalyticsModelTracker.objects.get(content_type=collector.content_type).state,
+                         AnalyticsModelTracker.READY)
+
+
+class RotatingFileSinkTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_rotation(self):
+        sink = RotatingFileSink(self.directory, 'test', max_bytes=100)
+        committed = []
+        events = ['{{"pk": {}, "name": "{}"}}\n'.format(pk, 'x' * 40) for pk in range(5)]
+        for pk, event in enumerate(events):
+            sink.write(event)
+            sink.commit(lambda pk=pk: committed.append(pk))
+        # Every other event fills a segment - the last one's bookkeeping waits on the seal
+        self.assertEqual(committed, [0, 1, 2, 3])
+        self.assertEqual(len(sink.segments), 2)
+        sink.close()
+        self.assertEqual(committed, [0, 1, 2, 3, 4])
+
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(names, sorted(os.path.basename(path) for path in sink.segments))
+        self.assertEqual(len(names), 3)
+        self.assertFalse([name for name in names if name.endswith('.part')])
+        contents = ""
+        for name in names:
+            with open(os.path.join(self.directory, name)) as segment:
+                contents += segment.read()
+        self.assertEqual(contents, "".join(events))
+
+    def test_sinks_get_their_own_segments(self):
+        first, second = RotatingFileSink(self.directory, 'test'), RotatingFileSink(self.directory, 'test')
+        for sink in (first, second):
+            sink.write('{"pk": 1}\n')
+            sink.close()
+        self.assertEqual(len(set(first.segments + second.segments)), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+class SyntheticModelTestCase(TestCase):
+    """The benchmark's synthetic model and history - created in the test database for each class"""
+    objects = 30
+    versions = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.model, cls.historical_model = get_models()
+        create_tables(cls.model, cls.historical_model)
+        populate(cls.model, cls.historical_model, cls.objects, cls.versions)
+        cls.pks = list(range(1, cls.objects + 1))
+
+
+class DumpResultTests(SyntheticModelTestCase):
+
+    def reference_dump(self, collector, item):
+        """dump_result as it was before the serialization plan - every value through clean_value and json"""
+        data = OrderedDict([('timestamp', item.get(collector.splunk_timestamp_field)), ('pk', item.get('pk'))])
+        for field, value in item.items():
+            value = clean_value(value)
+            if value is not None:
+                data[collector.field_map.get(field, field)] = value
+        return json.dumps(data, default=splunk_default, sort_keys=False)
+
+    def assertDumpsMatch(self):
+        collector = BenchmarkCollector()
+        collector.field_map = OrderedDict([('count', 'total'), ('created', 'created_date')])
+        items = collector.get_values(self.pks)
+        self.assertEqual(len(items), self.objects)
+        for item in items:
+            self.assertEqual(collector.dump_result(item), self.reference_dump(collector, item))
+
+    def test_json(self):
+        self.addCleanup(setattr, data_model, 'simplejson', data_model.simplejson)
+        data_model.simplejson = None
+        self.assertDumpsMatch()
+
+    @skipUnless(data_model.simplejson, "simplejson is not installed")
+    def test_simplejson(self):
+        self.assertDumpsMatch()
+
+
+class HistoricalAttributesTests(SyntheticModelTestCase):
+
+    def reference_attributes(self, historical_model, pks):
+        """get_historical_attributes as it was before the aggregate - a pass over every history row"""
+        results = {}
+        for pk, hist_date in historical_model.objects.filter(id__in=pks).values_list('id', 'history_date'):
+            if pk not in results:
+                results[pk] = OrderedDict([('historical_create_date', hist_date),
+                                           ('historical_last_change_date', hist_date),
+                                           ('historical_total_changes', 0),
+                                           ('historical_delta_days', 0)])
+            results[pk]['historical_total_changes'] += 1
+            if hist_date < results[pk]['historical_create_date']:
+                results[pk]['historical_create_date'] = hist_date
+            if hist_date > results[pk]['historical_last_change_date']:
+                results[pk]['historical_last_change_date'] = hist_date
+        for attributes in results.values():
+            delta = attributes['historical_last_change_date'] - attributes['historical_create_date']
+            attributes['historical_delta_days'] = (((delta.total_seconds() / 60.0) / 60.0) / 24.0)
+            attributes['historical_average_days'] = (attributes['historical_delta_days'] /
+                                                     float(attributes['historical_total_changes']))
+        return results
+
+    def test_matches_the_history(self):
+        pks = self.pks + [self.objects + 100]
+        attributes = BenchmarkCollector().get_historical_attributes(pks)
+        self.assertEqual(len(attributes), self.objects)
+        self.assertEqual(attributes, self.reference_attributes(self.historical_model, pks))
+
+
+class ChangeDetectionTests(SyntheticModelTestCase):
+
+    def analyze(self, change_detection):
+        sink = EventSink()
+        collector = BenchmarkCollector(sink=sink)
+        collector.change_detection = change_detection
+        collector.event_mode = 'append'
+        collector.analyze()
+        return sink.events
+
+    def change_history(self):
+        """Updates 1-5, deletes 6-8, adds 31-33 and adds then deletes 34 after the first run"""
+        date = now()
+        history = [self.historical_model(id=pk, name="Changed {}".format(pk), history_date=date, history_type='~')
+                   for pk in range(1, 6)]
+        history += [self.historical_model(id=pk, history_date=date, history_type='-') for pk in range(6, 9)]
+        history += [self.historical_model(id=pk, name="Object {}".format(pk), history_date=date,
+                                          history_type='+') for pk in range(31, 35)]
+        history.append(self.historical_model(id=34, history_date=date, history_type='-'))
+        self.historical_model.objects.bulk_create(history)
+        self.model.objects.filter(pk__in=range(1, 6)).update(name="Changed")
+        self.model.objects.filter(pk__in=range(6, 9)).delete()
+        self.model.objects.bulk_create([self.model(id=pk, name="Object {}".format(pk)) for pk in range(31, 34)])
+
+    def test_database_and_memory_agree(self):
+        self.analyze('database')
+        self.change_history()
+        collector = BenchmarkCollector()
+        collector.lock()
+        database, memory = collector.get_database_actions(), collector.get_memory_actions()
+        collector.unlock(advance=False)
+        self.assertEqual([sorted(pks) for pks in database], [[31, 32, 33], [1, 2, 3, 4, 5], [6, 7, 8]])
+        self.assertEqual([sorted(pks) for pks in memory], [sorted(pks) for pks in database])
+
+    def assertSentOnce(self, change_detection):
+        self.assertEqual(sorted([event['pk'] for event in self.analyze(change_detection)]), self.pks)
+        self.change_history()
+        events = self.analyze(change_detection)
+        self.assertEqual(sorted([event['pk'] for event in events]), [1, 2, 3, 4, 5, 6, 7, 8, 31, 32, 33])
+        self.assertEqual(sorted([event['pk'] for event in events if event.get('event_deleted')]), [6, 7, 8])
+
+    def test_updates_are_sent_once(self):
+        self.assertSentOnce('database')
+
+    def test_updates_are_sent_once_from_memory(self):
+        self.assertSentOnce('memory')
@@ -6,17 +6,30 @@ from __future__ import print_function
 
 import argparse
 import decimal
+import errno
+import functools
+import gzip
+import hashlib
+import io
+import itertools
 import json
 import logging
 import os
 import pprint
 import re
+import shutil
+import tempfile
+import threading
 import urllib
+import uuid
+import zlib
 from collections import OrderedDict
 import time
 import datetime
 import requests
 import sys
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 __author__ = 'Steven Klass'
 __date__ = '1/12/17 13:34'
@@ -27,6 +40,7 @@ log = logging.getLogger(__name__)
 SPLUNK_PREFERRED_DATETIME = "%Y-%m-%d %H:%M:%S:%f"
 INTS = re.compile(r"^-?[0-9]+$")
 NUMS = re.compile(r"^[+-]?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?$")
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
 def decimal_default(obj):
     if isinstance(obj, decimal.Decimal):
@@ -34,6 +48,16 @@ def decimal_default(obj):
     raise TypeError
 
 
+def chunked(iterable, size):
+    """Yields lists of at most `size` items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class SplunkAuthenticationException(Exception):
     def __init__(self, value, *args, **kwargs):
         self.value = value
@@ -50,6 +74,356 @@ class SplunkError(Exception):
         return repr(self.value)
 
 
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+# Held while finding / getting a session key so threads queue up behind a single login
+LOGIN_LOCK = threading.Lock()
+
+
+def get_session(base_url, pool_size=10, max_retries=3, backoff=0.5):
+    """The keep-alive session for a Splunk server - shared by every SplunkRequest in this process.
+
+    The pool is bounded (callers block for a free connection rather than opening more) and idempotent
+    requests are retried with backoff on connection errors and RETRY_STATUS_CODES.  Sessions are per
+    process so forked workers never share their parent's sockets.
+    """
+    key = (os.getpid(), base_url)
+    with SESSIONS_LOCK:
+        if key not in SESSIONS:
+            retries = Retry(total=max_retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS_CODES,
+                            raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True,
+                                  max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            SESSIONS[key] = session
+        return SESSIONS[key]
+
+
+def is_private(stat):
+    """Is a file / directory (its os.stat) ours alone - owned by us with no group or other access"""
+    return (not hasattr(os, 'getuid') or stat.st_uid == os.getuid()) and not stat.st_mode & 0o077
+
+
+def make_private_directory(directory):
+    """Creates directory (0700) if need be - False if it exists but others could get at it"""
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    if not is_private(os.stat(directory)):
+        log.warning("Not caching in %s - it is not private to this user", directory)
+        return False
+    return True
+
+
+def open_private_file(path):
+    """Opens path for reading - None if it's missing or isn't ours alone (someone may have planted it)"""
+    try:
+        cache_file = open(path)
+    except (IOError, OSError):
+        return None
+    if not is_private(os.fstat(cache_file.fileno())):
+        cache_file.close()
+        log.warning("Ignoring %s - it is not private to this user", path)
+        return None
+    return cache_file
+
+
+def write_private_file(path, data):
+    """Atomically replaces path with data as json readable by us alone (0600)"""
+    temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+    with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+        json.dump(data, cache_file)
+    os.rename(temp_path, path)
+
+
+class SplunkSessionCache(object):
+    """Session keys (with their expiry) by user@server in a json file so concurrent workers and cron
+    runs can reuse a login.  Writes are atomic renames - a race just costs an extra login.
+
+    Opt in by handing one to SplunkRequest(session_cache=...) - path must be in a directory private to
+    this user (i.e. settings.SPLUNK_ANALYTICS_SESSION_CACHE) and a file anyone else could have written
+    is never trusted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = make_private_directory(os.path.dirname(os.path.abspath(path)))
+
+    def read(self):
+        cache_file = open_private_file(self.path) if self.enabled else None
+        if cache_file is None:
+            return {}
+        try:
+            with cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            return {}
+
+    def write(self, data):
+        if not self.enabled:
+            return
+        try:
+            write_private_file(self.path, data)
+        except (IOError, OSError) as err:
+            log.warning("Unable to write Splunk session cache %s - %s", self.path, err)
+
+    def get(self, key):
+        entry = self.read().get(key)
+        if entry and entry['expires'] > time.time():
+            return entry['session_key']
+
+    def set(self, key, session_key, timeout):
+        data = dict([(k, v) for k, v in self.read().items() if v['expires'] > time.time()])
+        data[key] = {'session_key': session_key, 'expires': time.time() + timeout}
+        self.write(data)
+
+    def delete(self, key, session_key):
+        """Drops key - unless another worker has already replaced the session_key we found expired"""
+        data = self.read()
+        if data.get(key, {}).get('session_key') == session_key:
+            del data[key]
+            self.write(data)
+
+
+class DjangoSessionCache(object):
+    """Session keys in a Django cache - point it at a DatabaseCache to share them through the DB"""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get('splunk_session:{}'.format(key))
+
+    def set(self, key, session_key, timeout):
+        self.cache.set('splunk_session:{}'.format(key), session_key, timeout)
+
+    def delete(self, key, session_key):
+        if self.get(key) == session_key:
+            self.cache.delete('splunk_session:{}'.format(key))
+
+
+QUOTED_RE = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')''')
+
+
+class SplunkResultCache(object):
+    """Results of finished searches keyed on the normalized query plus its time bounds.
+
+        splunk = SplunkRequest(result_cache=SplunkResultCache(ttl=300, ttls=[(r'top limit', 3600)]))
+        results = splunk.search("source=icm_data | top limit=20 user", earliest_time='-24h')
+
+    Entries live for the ttl given to search(), else that of the first (pattern, ttl) in ttls to match the
+    query, else ttl.
+    The in memory copy is an LRU bounded by max_bytes, a backend (DiskResultCache / DjangoResultCache)
+    shares results across processes.  Identical searches made while one is running wait on it rather
+    than dispatching a job of their own.  hits / misses / collapsed / evictions are kept for tuning.
+    """
+
+    def __init__(self, ttl=300, ttls=None, max_bytes=64 * 1024 * 1024, backend=None):
+        self.ttl = ttl
+        self.ttls = [(re.compile(pattern), timeout) for pattern, timeout in (ttls or [])]
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+
+    def normalize(self, search_query):
+        # Whitespace inside a quoted string is part of what's searched for - only collapse it outside them
+        parts = QUOTED_RE.split(search_query.strip())
+        search_query = "".join(
+            part if index % 2 else re.sub(r'\s+', ' ', part) for index, part in enumerate(parts))
+        if not search_query.startswith('search'):
+            search_query = 'search {search_query}'.format(search_query=search_query)
+        return search_query
+
+    def get_key(self, search_query, **kwargs):
+        # kwargs are the job's time bounds (earliest_time / latest_time) and any other job parameters
+        data = [self.normalize(search_query), sorted(kwargs.items())]
+        return hashlib.sha1(json.dumps(data, default=str).encode('utf-8')).hexdigest()
+
+    def get_ttl(self, search_query, ttl=None):
+        if ttl is not None:
+            return ttl
+        for pattern, timeout in self.ttls:
+            if pattern.search(search_query):
+                return timeout
+        return self.ttl
+
+    def get(self, key):
+        """The cached payload for key (most recently used now) - None if it's missing or expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, payload = self.entries.pop(key)
+        if expires <= time.time():
+            self.bytes -= len(payload)
+            return None
+        self.entries[key] = (expires, payload)
+        return payload
+
+    def set(self, key, payload, ttl):
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key)[1])
+        if len(payload) > self.max_bytes:
+            return
+        self.entries[key] = (time.time() + ttl, payload)
+        self.bytes += len(payload)
+        while self.bytes > self.max_bytes:
+            _key, (_expires, evicted) = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def get_or_run(self, search_query, run, ttl=None, **kwargs):
+        """Cached results for the search - else run() once, however many threads are asking"""
+        key = self.get_key(search_query, **kwargs)
+        with self.lock:
+            payload = self.get(key)
+            if payload is not None:
+                self.hits += 1
+                return json.loads(payload)
+            waiting = key in self.in_flight
+            if waiting:
+                self.collapsed += 1
+                in_flight = self.in_flight[key]
+            else:
+                in_flight = self.in_flight[key] = {'done': threading.Event(), 'payload': None, 'error': None}
+
+        if waiting:
+            in_flight['done'].wait()
+            if in_flight['error'] is not None:
+                raise in_flight['error']
+            return json.loads(in_flight['payload'])
+
+        ttl = self.get_ttl(search_query, ttl)
+        try:
+            payload = self.backend.get(key) if self.backend is not None else None
+            with self.lock:
+                if payload is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if payload is None:
+                payload = json.dumps(run())
+                if self.backend is not None:
+                    self.backend.set(key, payload, ttl)
+            with self.lock:
+                self.set(key, payload, ttl)
+            in_flight['payload'] = payload
+        except Exception as err:
+            in_flight['error'] = err
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            in_flight['done'].set()
+        return json.loads(payload)
+
+    def stats(self):
+        return OrderedDict([('hits', self.hits), ('misses', self.misses), ('collapsed', self.collapsed),
+                            ('evictions', self.evictions), ('entries', len(self.entries)), ('bytes', self.bytes)])
+
+
+class DiskResultCache(object):
+    """A SplunkResultCache backend - one json file per result in directory, shared by every process.
+
+    The directory must be private to this user (results can be sensitive) and files are written 0600.
+    Expired results are removed by cleanup(), run from set() at most every cleanup_interval seconds.
+    """
+
+    def __init__(self, directory=None, cleanup_interval=300):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'splunk_results')
+        self.enabled = make_private_directory(self.directory)
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = time.time()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+    def read(self, path):
+        cache_file = open_private_file(path) if self.enabled else None
+        if cache_file is None:
+            return None
+        try:
+            with cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            return None
+
+    def get(self, key):
+        entry = self.read(self.get_path(key))
+        if entry and entry['expires'] > time.time():
+            return entry['payload']
+
+    def set(self, key, payload, timeout):
+        if not self.enabled:
+            return
+        path = self.get_path(key)
+        try:
+            write_private_file(path, {'expires': time.time() + timeout, 'payload': payload})
+        except (IOError, OSError) as err:
+            log.warning("Unable to write Splunk result cache %s - %s", path, err)
+        if time.time() - self.last_cleanup > self.cleanup_interval:
+            self.cleanup()
+
+    def cleanup(self):
+        """Removes expired results and temp files left behind by a dead writer - returns how many"""
+        self.last_cleanup = now = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                try:
+                    expired = os.stat(path).st_mtime < now - self.cleanup_interval
+                except OSError:
+                    continue
+            elif name.endswith('.json'):
+                entry = self.read(path)
+                expired = entry is not None and entry['expires'] <= now
+            else:
+                continue
+            if expired:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        if removed:
+            log.debug("Removed %d expired Splunk results from %s", removed, self.directory)
+        return removed
+
+
+class DjangoResultCache(object):
+    """A SplunkResultCache backend on a Django cache"""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get('splunk_results:{}'.format(key))
+
+    def set(self, key, payload, timeout):
+        self.cache.set('splunk_results:{}'.format(key), payload, timeout)
+
+
 class SplunkRequest(object):
 
     def __init__(self, *args, **kwargs):
@@ -57,43 +431,97 @@ class SplunkRequest(object):
         self.password = kwargs.get('password', 'changeme')
         self.host = kwargs.get('host', 'localhost')
         self.port = kwargs.get('port', '8089')
+        self.scheme = kwargs.get('scheme', 'https')
         self.session_key = kwargs.get('splunk_session_key')
+        self.poll_interval = kwargs.get('poll_interval', 0.25)
+        self.max_poll_interval = kwargs.get('max_poll_interval', 5.0)
+        # Seconds we wait on a search before cancelling it - None to wait forever
+        self.search_timeout = kwargs.get('search_timeout', 1800)
+        self.page_size = kwargs.get('page_size', 10000)
+        self.pool_size = kwargs.get('pool_size', 10)
+        self.max_retries = kwargs.get('max_retries', 3)
+        self.verify = kwargs.get('verify', False)
+        # Where session keys are shared (None always logs in) and how long we trust one for - Splunk
+        # expires an idle session after an hour by default, a 401 before then just means a new login.
+        self.session_cache = kwargs.get('session_cache')
+        self.session_timeout = kwargs.get('session_timeout', 3300)
+        self.result_cache = kwargs.get('result_cache')
         self.session = None
-        self.base_url = 'https://{host}:{port}'.format(host=self.host, port=self.port)
+        self.headers = None
+        self.requests = 0
+        self.retries = 0
+        self.base_url = '{scheme}://{host}:{port}'.format(scheme=self.scheme, host=self.host, port=self.port)
+        self.cache_key = '{}@{}'.format(self.username, self.base_url)
 
     def connect(self, **kwargs):
-        if self.session_key:
-            return
-
-        if self.session:
-            return self.session
+        """Gets the shared session and a session key - given, cached by another worker or a new login"""
+        if self.session is None:
+            self.session = get_session(self.base_url, pool_size=self.pool_size, max_retries=self.max_retries)
+        if self.session_key is None:
+            with LOGIN_LOCK:
+                if self.session_cache is not None:
+                    self.session_key = self.session_cache.get(self.cache_key)
+                if self.session_key:
+                    log.debug("Reusing cached session key for %s", self.cache_key)
+                else:
+                    self.login()
+        if self.headers is None:
+            self.headers = {'Authorization': 'Splunk {session_key}'.format(session_key=self.session_key),
+                            'content-type': 'application/json'}
+        return self.session
 
-        self.session = requests.Session()
+    def login(self):
         try:
             url = '{base_url}/services/auth/login?output_mode=json'.format(base_url=self.base_url)
             request = self.session.post(
                 url, data={'username': self.username, 'password': self.password},
-                auth=(self.username, self.password), verify=False)
+                auth=(self.username, self.password), verify=self.verify)
+            self.requests += 1
             if request.status_code != 200:
                 raise SplunkAuthenticationException(
                     "Authorization error ({status_code}) connecting to {url}".format(
                         status_code=request.status_code, url=url))
             self.session_key = request.json().get('sessionKey')
-            self.headers = {'Authorization': 'Splunk {session_key}'.format(**self.__dict__),
-                            'content-type': 'application/json'}
+            self.headers = None
         except:
-            log.error("Issue connecting to %(base_url)s with %(username)s:%(password)s", self.__dict__)
+            log.error("Issue connecting to %(base_url)s with %(username)s", self.__dict__)
             raise
-        log.debug("Successfully logged in and have session key %(session_key)s", self.__dict__)
+        if self.session_cache is not None:
+            self.session_cache.set(self.cache_key, self.session_key, self.session_timeout)
+        log.debug("Successfully logged in to %(base_url)s", self.__dict__)
 
-    def create_search(self, search_query):
-        """Create a basic search"""
+    def expire_session_key(self):
+        """Forget our session key - the next connect() picks up a newer cached one or logs in"""
+        with LOGIN_LOCK:
+            if self.session_cache is not None:
+                self.session_cache.delete(self.cache_key, self.session_key)
+            self.session_key = None
+            self.headers = None
+
+    def request(self, method, url, **kwargs):
+        """Every REST call goes through here - a 401 means our session key expired so we log in again"""
+        self.connect()
+        kwargs.setdefault('verify', self.verify)
+        response = self.session.request(method, url, headers=self.headers, **kwargs)
+        self.requests += 1
+        if response.status_code == 401:
+            log.info("Session key for %s was rejected - logging in again", self.cache_key)
+            response.close()
+            self.expire_session_key()
+            self.connect()
+            self.retries += 1
+            response = self.session.request(method, url, headers=self.headers, **kwargs)
+            self.requests += 1
+        return response
+
+    def create_search(self, search_query, **kwargs):
+        """Create a basic search - kwargs (earliest_time, latest_time ..) are passed on to the job"""
         self.connect()
         if not search_query.startswith('search'):
             search_query = 'search {search_query}'.format(search_query=search_query)
-        request = self.session.post(
-            '{base_url}/services/search/jobs?output_mode=json'.format(base_url=self.base_url),
-            headers=self.headers, data={'search': search_query}, verify=False)
+        request = self.request(
+            'post', '{base_url}/services/search/jobs?output_mode=json'.format(base_url=self.base_url),
+            data=dict(kwargs, search=search_query))
 
         data = request.json()
         if data.get('messages') and data.get('messages')[0].get('type') == 'FATAL':
@@ -102,23 +530,114 @@ class SplunkRequest(object):
         log.debug("Created search on {search} and id = {sid}".format(search=search_query, **data))
         return data.get('sid')
 
-    def get_search_status(self, search_id, wait_for_results=True):
+    def search(self, search_query, ttl=None, **kwargs):
+        """Runs a search and returns its results - through the result_cache when we have one"""
+        if self.result_cache is None:
+            return self.run_search(search_query, **kwargs)
+        run = functools.partial(self.run_search, search_query, **kwargs)
+        return self.result_cache.get_or_run(search_query, run, ttl=ttl, **kwargs)
 
-        self.connect()
+    def run_search(self, search_query, **kwargs):
+        search_id = self.create_search(search_query, **kwargs)
+        if not search_id:
+            raise SplunkError("Search {} was not created".format(search_query))
+        results, status_code = self.get_search_status(search_id)
+        if status_code != 200:
+            raise SplunkError("Search {} returned ({})".format(search_id, status_code))
+        return results
+
+    def get_search_status(self, search_id, wait_for_results=True, timeout=None):
+        """Waits on the job (if asked) and then fetches the results once"""
+        if wait_for_results:
+            self.wait_for_search(search_id, timeout=timeout)
+        return self.get_search_results(search_id)
+
+    def get_search_results(self, search_id):
         url = '{base_url}/services/search/jobs/{search_id}/results?output_mode=json'
-        start = None
+        request = self.request('get', url.format(base_url=self.base_url, search_id=search_id))
+        return request.json(), request.status_code
+
+    def get_job_status(self, search_id):
+        """Lightweight job status - the content with dispatchState, isDone, isFailed etc."""
+        if not search_id:
+            raise SplunkError("No search id to check")
+        url = '{base_url}/services/search/jobs/{search_id}?output_mode=json'
+        request = self.request('get', url.format(base_url=self.base_url, search_id=search_id))
+        if request.status_code in RETRY_STATUS_CODES:
+            return {'dispatchState': 'UNKNOWN', 'isDone': False, 'isFailed': False}
+        if request.status_code != 200:
+            # i.e. a 404 for an expired / unknown sid - polling again won't change that
+            raise SplunkError("Status of {} returned ({})".format(search_id, request.status_code))
+        return request.json().get('entry', [{}])[0].get('content', {})
+
+    def is_search_done(self, status):
+        if status.get('isFailed') in (True, 1, '1') or status.get('dispatchState') == 'FAILED':
+            raise SplunkError("Search failed - {}".format(status.get('messages') or status.get('dispatchState')))
+        return status.get('isDone') in (True, 1, '1') or status.get('dispatchState') == 'DONE'
+
+    def cancel_search(self, search_id):
+        url = '{base_url}/services/search/jobs/{search_id}/control?output_mode=json'
+        request = self.request('post', url.format(base_url=self.base_url, search_id=search_id),
+                               data={'action': 'cancel'})
+        log.debug("Cancelled search %s (%s)", search_id, request.status_code)
+        return request.status_code
+
+    def wait_for_search(self, search_id, timeout=None):
+        """Polls the job status with exponential backoff - cancels the job if we pass the deadline"""
+        timeout = timeout if timeout is not None else self.search_timeout
+        deadline = time.time() + timeout if timeout else None
+        delay = self.poll_interval
         while True:
-            request = self.session.get(url.format(base_url=self.base_url, search_id=search_id),
-                                   headers=self.headers, verify=False)
-            if not wait_for_results:
-                break
-            if not start or (datetime.datetime.now() - start).seconds > 5:
-                log.debug("Waiting on results")
-                start = datetime.datetime.now()
-            if request.status_code == 200:
+            status = self.get_job_status(search_id)
+            if self.is_search_done(status):
+                return status
+            if deadline and time.time() + delay > deadline:
+                self.cancel_search(search_id)
+                raise SplunkError("Search {} did not finish within {}s".format(search_id, timeout))
+            log.debug("Waiting on %s (%s)", search_id, status.get('dispatchState'))
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    def iter_search_results(self, search_id, page_size=None, normalize=True, wait_for_results=True):
+        """Yields the results a page (count / offset) at a time so memory is bound by the page size"""
+        if wait_for_results:
+            self.wait_for_search(search_id)
+        url = '{base_url}/services/search/jobs/{search_id}/results'.format(
+            base_url=self.base_url, search_id=search_id)
+        page_size = page_size or self.page_size
+        offset = 0
+        while True:
+            request = self.request('get', url, params={
+                'output_mode': 'json', 'count': page_size, 'offset': offset})
+            if request.status_code != 200:
+                raise SplunkError("Results for {} at offset {} returned ({})".format(
+                    search_id, offset, request.status_code))
+            rows = request.json().get('results', [])
+            for row in rows:
+                yield self.get_normalized_data(row) if normalize else row
+            if len(rows) < page_size:
                 break
-            time.sleep(.5)
-        return request.json(), request.status_code
+            offset += len(rows)
+
+    def export_search(self, search_query, normalize=True, **kwargs):
+        """Runs a search on the streaming export endpoint - rows are parsed and yielded as they arrive"""
+        if not search_query.startswith('search') and not search_query.startswith('|'):
+            search_query = 'search {search_query}'.format(search_query=search_query)
+        data = dict(kwargs, search=search_query, output_mode='json')
+        request = self.request('post', '{base_url}/services/search/jobs/export'.format(base_url=self.base_url),
+                               data=data, stream=True)
+        try:
+            if request.status_code != 200:
+                raise SplunkError("Export of {} returned ({})".format(search_query, request.status_code))
+            for line in request.iter_lines():
+                if not line:
+                    continue
+                row = json.loads(line)
+                if row.get('preview') or row.get('result') is None:
+                    continue
+                yield self.get_normalized_data(row['result']) if normalize else row['result']
+        finally:
+            request.close()
 
     def get_normalized_data(self, content):
 
@@ -145,6 +664,418 @@ class SplunkRequest(object):
 
 
 
+class SplunkSearchJobs(object):
+    """Tracks a batch of searches and hands them back as they finish.
+
+        jobs = SplunkSearchJobs(splunk, max_concurrent=4)
+        for query in queries:
+            jobs.submit(query)
+        for key, search_id, results, error in jobs.as_completed():
+            ...
+
+    All pending jobs are polled through the lightweight job status endpoint each round with a shared
+    exponential backoff, results are only fetched once per finished job.
+    """
+
+    def __init__(self, splunk, max_concurrent=None, timeout=None, fetch_results=True):
+        self.splunk = splunk
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout if timeout is not None else splunk.search_timeout
+        self.fetch_results = fetch_results
+        self.queued = []
+        self.pending = OrderedDict()
+        self.completed = []
+
+    def submit(self, search_query, key=None):
+        """Queue a search - it's dispatched right away unless we are at max_concurrent"""
+        self.queued.append((key if key is not None else search_query, search_query))
+        self.dispatch()
+
+    def dispatch(self):
+        while self.queued and (not self.max_concurrent or len(self.pending) < self.max_concurrent):
+            key, search_query = self.queued.pop(0)
+            try:
+                search_id = self.splunk.create_search(search_query)
+                if not search_id:
+                    raise SplunkError("Search was not created")
+            except Exception as err:
+                self.completed.append((key, None, None, err))
+            else:
+                self.pending[search_id] = (key, time.time())
+
+    def poll(self):
+        """Checks every pending job once - returns the number which finished"""
+        finished = 0
+        for search_id, (key, started) in list(self.pending.items()):
+            error, results = None, None
+            try:
+                if not self.splunk.is_search_done(self.splunk.get_job_status(search_id)):
+                    if not self.timeout or time.time() - started < self.timeout:
+                        continue
+                    self.splunk.cancel_search(search_id)
+                    raise SplunkError("Search {} did not finish within {}s".format(search_id, self.timeout))
+                if self.fetch_results:
+                    results, status_code = self.splunk.get_search_results(search_id)
+                    if status_code != 200:
+                        raise SplunkError("Search {} returned ({})".format(search_id, status_code))
+            except Exception as err:
+                error = err
+            del self.pending[search_id]
+            self.completed.append((key, search_id, results, error))
+            finished += 1
+        return finished
+
+    def as_completed(self):
+        """Yields (key, search_id, results, error) as each job finishes"""
+        delay = self.splunk.poll_interval
+        while self.queued or self.pending or self.completed:
+            while self.completed:
+                yield self.completed.pop(0)
+            if not self.pending and not self.queued:
+                break
+            if self.poll():
+                delay = self.splunk.poll_interval
+            else:
+                time.sleep(delay)
+                delay = min(delay * 2, self.splunk.max_poll_interval)
+            self.dispatch()
+
+    def cancel(self):
+        for search_id in list(self.pending.keys()):
+            self.splunk.cancel_search(search_id)
+        self.pending.clear()
+        self.queued = []
+
+
+
+class SplunkHECSender(object):
+    """Sends events in batches to the Splunk HTTP Event Collector (HEC).
+
+    Events go to the raw endpoint newline delimited - exactly what we would write to a file for a
+    forwarder - so timestamp extraction is the same.  This behaves like a file (write / flush /
+    close) so it can be handed to a collector as its sink.  Batches are sent when they hit
+    max_events, max_bytes or max_wait seconds (a timer sends a batch nothing else gets written to),
+    and flush() only returns once the batch has been accepted (and acknowledged when a channel is
+    used) so bookkeeping can follow it.  A batch that can't be delivered is dropped and the sender
+    refuses anything more - its events were never recorded so the next run sends them again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.token = kwargs.get('token')
+        self.host = kwargs.get('host', 'localhost')
+        self.port = kwargs.get('port', '8088')
+        self.scheme = kwargs.get('scheme', 'https')
+        self.source = kwargs.get('source')
+        self.sourcetype = kwargs.get('sourcetype', '_json')
+        self.index = kwargs.get('index')
+        self.channel = kwargs.get('channel')
+        self.use_ack = kwargs.get('use_ack', False)
+        self.max_events = kwargs.get('max_events', 1000)
+        self.max_bytes = kwargs.get('max_bytes', 1024 * 1024)
+        self.max_wait = kwargs.get('max_wait', 5.0)
+        self.compress = kwargs.get('compress', False)
+        self.max_retries = kwargs.get('max_retries', 5)
+        self.backoff = kwargs.get('backoff', 0.5)
+        self.ack_timeout = kwargs.get('ack_timeout', 60)
+        self.pool_size = kwargs.get('pool_size', 4)
+        self.timeout = kwargs.get('timeout', 30)
+        self.verify = kwargs.get('verify', False)
+        self.base_url = '{scheme}://{host}:{port}'.format(scheme=self.scheme, host=self.host, port=self.port)
+        if self.use_ack and not self.channel:
+            self.channel = str(uuid.uuid4())
+        self.session = None
+        self.events = []
+        self.events_bytes = 0
+        self.batch_started = None
+        self.timer = None
+        self.lock = threading.RLock()
+        self.error = None
+        self.events_sent = 0
+        self.batches_sent = 0
+        self.requests = 0
+        self.retries = 0
+
+    def connect(self):
+        if self.session:
+            return self.session
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Authorization': 'Splunk {token}'.format(token=self.token)})
+        if self.channel:
+            self.session.headers.update({'X-Splunk-Request-Channel': self.channel})
+        return self.session
+
+    def write(self, data):
+        for event in data.splitlines():
+            if event:
+                self.send(event)
+
+    def send(self, event):
+        with self.lock:
+            self.check()
+            if not self.events:
+                self.batch_started = time.time()
+                self.start_timer()
+            self.events.append(event)
+            self.events_bytes += len(event) + 1
+            if len(self.events) >= self.max_events or self.events_bytes >= self.max_bytes or \
+                    (self.max_wait is not None and time.time() - self.batch_started >= self.max_wait):
+                self.flush()
+
+    def check(self):
+        if self.error is not None:
+            raise SplunkError("HEC sender to {base_url} failed earlier - {error}".format(
+                base_url=self.base_url, error=self.error))
+
+    def start_timer(self):
+        """Sends the batch after max_wait even if nothing else is written (i.e. while we read the next page)"""
+        if self.max_wait is None:
+            return
+        self.timer = threading.Timer(self.max_wait, self.flush_waiting)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def stop_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def flush_waiting(self):
+        with self.lock:
+            if self.error is not None or not self.events or time.time() - self.batch_started < self.max_wait:
+                return
+            try:
+                self.flush()
+            except Exception:
+                # Kept in self.error - the writer gets it on its next send / flush
+                log.exception("Timed HEC batch to %s failed", self.base_url)
+
+    def flush(self):
+        """Sends whatever is buffered - raises SplunkError if it can't be delivered"""
+        with self.lock:
+            self.check()
+            self.stop_timer()
+            if not self.events:
+                return
+            events = self.events
+            self.events = []
+            self.events_bytes = 0
+            self.batch_started = None
+            body = "\n".join(events).encode('utf-8')
+            try:
+                response = self.post('{base_url}/services/collector/raw', body, compress=self.compress)
+                if self.use_ack:
+                    self.wait_for_ack(response.json().get('ackId'))
+            except Exception as err:
+                self.error = err
+                log.error("Dropped %d events for %s - %s", len(events), self.base_url, err)
+                raise
+            log.debug("Sent %d events (%d bytes) to %s", len(events), len(body), self.base_url)
+            self.events_sent += len(events)
+            self.batches_sent += 1
+
+    def discard(self):
+        """Drops anything buffered without sending it - the run writing it failed"""
+        with self.lock:
+            self.stop_timer()
+            if self.events:
+                log.warning("Discarding %d unsent events for %s", len(self.events), self.base_url)
+            self.events = []
+            self.events_bytes = 0
+            self.batch_started = None
+
+    def close(self):
+        with self.lock:
+            if self.error is None:
+                self.flush()
+            else:
+                self.discard()
+        if self.session:
+            self.session.close()
+            self.session = None
+
+    def post(self, url, body, compress=False):
+        """Posts with retries and exponential backoff on connection errors and busy responses"""
+        self.connect()
+        url = url.format(base_url=self.base_url)
+        params = dict([(k, v) for k, v in [('source', self.source), ('sourcetype', self.sourcetype),
+                                           ('index', self.index)] if v])
+        headers = {}
+        if compress:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                response = self.session.post(url, params=params, data=body, headers=headers,
+                                             verify=self.verify, timeout=self.timeout)
+            except requests.RequestException as err:
+                error = repr(err)
+            else:
+                if response.status_code == 200:
+                    return response
+                error = "({status_code}) {text}".format(status_code=response.status_code, text=response.text)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise SplunkError("HEC rejected batch to {url} {error}".format(url=url, error=error))
+            attempt += 1
+            if attempt > self.max_retries:
+                raise SplunkError("Unable to send batch to {url} after {attempt} attempts {error}".format(
+                    url=url, attempt=attempt, error=error))
+            delay = self.backoff * 2 ** (attempt - 1)
+            self.retries += 1
+            log.warning("HEC batch to %s failed %s - retrying in %.1fs", url, error, delay)
+            time.sleep(delay)
+
+    def wait_for_ack(self, ack_id):
+        """Polls the ack endpoint until the indexers have committed the batch"""
+        url = '{base_url}/services/collector/ack'.format(base_url=self.base_url)
+        deadline = time.time() + self.ack_timeout
+        delay = self.backoff
+        while True:
+            self.requests += 1
+            response = self.session.post(url, params={'channel': self.channel}, json={'acks': [ack_id]},
+                                         verify=self.verify, timeout=self.timeout)
+            if response.status_code == 200 and response.json().get('acks', {}).get(str(ack_id)):
+                return
+            if time.time() + delay > deadline:
+                raise SplunkError("Batch {ack_id} was not acknowledged within {timeout}s".format(
+                    ack_id=ack_id, timeout=self.ack_timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+
+
+class RotatingFileSink(object):
+    """One NDJSON stream per source, handed to a SplunkForwarder a segment at a time.
+
+    Events are appended (buffered) to a hidden in-progress segment.  Once it passes max_bytes or is
+    older than max_age seconds it's fsync'd, optionally gzip'd and atomically renamed into
+    <source>-<timestamp>-<pid>-<token>-<sequence>.json[.gz] - point the forwarder monitor at those so it
+    never tails a partial or multi-GB file.  Callbacks given to commit() (our bookkeeping) only run
+    once the segment holding their events has been sealed.
+    """
+
+    def __init__(self, directory, source, **kwargs):
+        self.directory = directory
+        self.source = source
+        self.max_bytes = kwargs.get('max_bytes', 256 * 1024 * 1024)
+        self.max_age = kwargs.get('max_age', 300)
+        self.compress = kwargs.get('compress', False)
+        self.fsync_interval = kwargs.get('fsync_interval')
+        self.buffer_size = kwargs.get('buffer_size', 1024 * 1024)
+        self.stream = None
+        self.segment_path = None
+        self.segment_bytes = 0
+        self.segment_started = None
+        self.last_fsync = None
+        self.sequence = 0
+        # Sinks opened one after another in the same process and second still get their own names
+        self.token = uuid.uuid4().hex[:8]
+        self.pending = []
+        self.segments = []
+
+    def open_segment(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.sequence += 1
+        self.segment_started = time.time()
+        self.last_fsync = self.segment_started
+        self.segment_name = '{source}-{stamp}-{pid}-{token}-{sequence:06d}.json'.format(
+            source=self.source, stamp=time.strftime('%Y%m%d%H%M%S'), pid=os.getpid(), token=self.token,
+            sequence=self.sequence)
+        self.segment_path = os.path.join(self.directory, '.{}.part'.format(self.segment_name))
+        self.stream = io.open(self.segment_path, 'ab', buffering=self.buffer_size)
+        self.segment_bytes = 0
+
+    def write(self, data):
+        if self.stream is None:
+            self.open_segment()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.stream.write(data)
+        self.segment_bytes += len(data)
+        if self.segment_bytes >= self.max_bytes or time.time() - self.segment_started >= self.max_age:
+            self.seal()
+
+    def flush(self):
+        if self.stream is None:
+            return
+        self.stream.flush()
+        if self.fsync_interval is not None and time.time() - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.stream.fileno())
+            self.last_fsync = time.time()
+
+    def commit(self, callback):
+        """Run callback once everything written so far is in a durable segment"""
+        self.flush()
+        if self.stream is None:
+            callback()
+        else:
+            self.pending.append(callback)
+
+    def seal(self):
+        """fsync the current segment and hand it off to the forwarder under its final name"""
+        if self.stream is not None:
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+            self.stream.close()
+            self.stream = None
+
+            final_path = os.path.join(self.directory, self.segment_name)
+            if self.compress:
+                compressed_path = '{}.gz'.format(self.segment_path)
+                with io.open(self.segment_path, 'rb') as source, gzip.open(compressed_path, 'wb') as target:
+                    shutil.copyfileobj(source, target, self.buffer_size)
+                with io.open(compressed_path, 'rb') as target:
+                    os.fsync(target.fileno())
+                os.remove(self.segment_path)
+                self.segment_path, final_path = compressed_path, '{}.gz'.format(final_path)
+            self.publish(self.segment_path, final_path)
+            self.fsync_directory()
+            self.segments.append(final_path)
+            log.debug("Sealed %s (%d bytes)", final_path, self.segment_bytes)
+
+        pending, self.pending = self.pending, []
+        for callback in pending:
+            callback()
+
+    def publish(self, path, final_path):
+        """Moves path to final_path - never over an existing segment (a link fails if the name is taken)"""
+        try:
+            os.link(path, final_path)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                raise
+            # No hard links here (i.e. some network filesystems) - check then rename
+            if os.path.exists(final_path):
+                raise OSError(errno.EEXIST, "Segment already exists", final_path)
+            os.rename(path, final_path)
+        else:
+            os.remove(path)
+
+    def fsync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.seal()
+
+
+
 def main(args):
     """Main - $<description>$"""
     logging.basicConfig(
@@ -157,9 +1088,8 @@ def main(args):
 
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', args.settings)
 
-    splunk = SplunkRequest()
-    search_id = splunk.create_search("source=icm_data| top limit=20 user")
-    results = splunk.get_search_status(search_id)
+    splunk = SplunkRequest(result_cache=SplunkResultCache(backend=DiskResultCache()))
+    results = splunk.search("source=icm_data| top limit=20 user")
 
     pprint.pprint(results)
 